@@ -1,4 +1,7 @@
+import sqlite3
 from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
@@ -21,11 +24,39 @@ def create_app():
     # Import routes, models after initializing app (deferred import to avoid circular import)
     with app.app_context():
         from . import routes  # Import routes after app is initialized
+        from . import commands  # Register the flask CLI commands
         from .models import User  # Import models after app is initialized
         db.create_all()  # Create tables after everything is set
 
+        from .schema import ensure_cascading_foreign_keys, ensure_foreign_key_indexes
+        ensure_cascading_foreign_keys()  # Older databases lack the models' ON DELETE actions
+        ensure_foreign_key_indexes()  # ... and the indexes on their foreign key columns
+
+        from .search import ensure_search_index
+        ensure_search_index()  # Full-text index over the question bank
+
+        from .dedupe import ensure_duplicate_index
+        ensure_duplicate_index()  # MinHash signatures behind the near-duplicate warning
+
+        from .statistics import ensure_score_distributions
+        ensure_score_distributions()  # Per-exam grade histograms behind percentile ranks
+
+        from .scheduler import init_scheduler
+        init_scheduler(app)  # Pre-warms and finalizes exams around date_scheduled
+
+        from .profiler import init_profiler
+        init_profiler(app)  # Flamegraph profiles of token-carrying and sampled requests
+
     return app
 
+# SQLite ignores foreign keys (and their ON DELETE CASCADE) unless enabled per connection
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 # Define the user loader here to avoid circular imports
 @login_manager.user_loader
 def load_user(user_id):
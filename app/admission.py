@@ -0,0 +1,155 @@
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import ExamAdmission, AdmissionControl
+
+_slots = {}  # Per-process semaphore bounding concurrent take_exam/submit_exam handlers
+_slots_lock = threading.Lock()
+
+
+def exam_limits(control, config=None):
+    # Per-exam overrides fall back to the configured defaults
+    config = config or current_app.config
+    rate = (control and control.rate_per_second) or config['ADMISSION_RATE']
+    burst = (control and control.burst) or config['ADMISSION_BURST']
+    return rate, burst
+
+
+def admission_control(exam_id):
+    control = db.session.get(AdmissionControl, exam_id)
+    if control is None:
+        # Concurrent first requests all try to create the row; only one insert takes effect
+        db.session.execute(sqlite_insert(AdmissionControl).values(
+            exam_id=exam_id, tokens=current_app.config['ADMISSION_BURST'], refilled_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['exam_id']))
+        control = db.session.get(AdmissionControl, exam_id)
+    return control
+
+
+def admit_waiting(exam_id):
+    """Refill the exam's token bucket and admit that many students from the head of the queue."""
+    control = admission_control(exam_id)
+    db.session.refresh(control)
+    rate, burst = exam_limits(control)
+    now = datetime.utcnow()
+    tokens = min(burst, control.tokens + rate * (now - control.refilled_at).total_seconds())
+
+    waiting = []
+    if tokens >= 1:
+        waiting = [user_id for (user_id,) in db.session.query(ExamAdmission.user_id)
+                   .filter_by(exam_id=exam_id, admitted_at=None)
+                   .order_by(ExamAdmission.queued_at, ExamAdmission.user_id).limit(int(tokens))]
+
+    # Spend the tokens only if no other request refilled the bucket since it was read;
+    # the one that did has admitted the head of the queue already
+    claimed = AdmissionControl.query.filter_by(
+        exam_id=exam_id, tokens=control.tokens, refilled_at=control.refilled_at
+    ).update({'tokens': tokens - len(waiting), 'refilled_at': now}, synchronize_session=False)
+    if claimed and waiting:
+        ExamAdmission.query.filter(
+            ExamAdmission.exam_id == exam_id,
+            ExamAdmission.user_id.in_(waiting),
+            ExamAdmission.admitted_at == None
+        ).update({'admitted_at': now}, synchronize_session=False)
+    db.session.commit()
+
+
+def admit_student(exam_id, user_id):
+    """Return the student's admission, queueing them and admitting whoever is next in line."""
+    admission = db.session.get(ExamAdmission, (exam_id, user_id))
+    if admission and admission.admitted_at:
+        return admission
+    if admission is None:
+        # A double-click queues the student once
+        db.session.execute(sqlite_insert(ExamAdmission).values(
+            exam_id=exam_id, user_id=user_id, queued_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['exam_id', 'user_id']))
+        admission = db.session.get(ExamAdmission, (exam_id, user_id))
+    admit_waiting(exam_id)
+    return admission
+
+
+def available_tokens(control, config=None):
+    # Tokens the bucket would hold if refilled now, read without writing; no row yet means a full bucket
+    rate, burst = exam_limits(control, config)
+    if control is None:
+        return burst
+    return min(burst, control.tokens + rate * (datetime.utcnow() - control.refilled_at).total_seconds())
+
+
+def queue_position_query(admission):
+    """Statement counting the students queued before this one who are still waiting.
+
+    Shared with the async waiting-room endpoint, which runs it on its own session.
+    """
+    return db.select(db.func.count()).select_from(ExamAdmission).where(
+        ExamAdmission.exam_id == admission.exam_id,
+        ExamAdmission.admitted_at == None,
+        db.or_(ExamAdmission.queued_at < admission.queued_at,
+               db.and_(ExamAdmission.queued_at == admission.queued_at, ExamAdmission.user_id < admission.user_id))
+    )
+
+
+def queue_position(admission):
+    return db.session.scalar(queue_position_query(admission))
+
+
+def waiting_status(position, rate):
+    return {'admitted': False, 'queued': True, 'position': position + 1,
+            'estimated_wait': round((position + 1) / rate)}
+
+
+def queue_status(exam_id, user_id):
+    """Status for the waiting room poll; writes only when the bucket has a token to spend."""
+    admission = db.session.get(ExamAdmission, (exam_id, user_id))
+    if admission is None:
+        return {'admitted': False, 'queued': False}
+    if not admission.admitted_at:
+        control = admission_control(exam_id)
+        rate, burst = exam_limits(control)
+        # Any poll may admit, so the queue keeps moving after the students ahead stop polling
+        if available_tokens(control) >= 1:
+            admit_waiting(exam_id)
+        if not admission.admitted_at:
+            return waiting_status(queue_position(admission), rate)
+    return {'admitted': True, 'queued': True}
+
+
+def exam_deadline(admission, exam):
+    """When the student's time runs out: the full duration counted from admission, not from queueing."""
+    return admission.admitted_at + timedelta(minutes=exam.duration)
+
+
+def queued_seconds(admission):
+    return int((admission.admitted_at - admission.queued_at).total_seconds())
+
+
+def _process_slots():
+    limit = current_app.config['ADMISSION_MAX_CONCURRENT']
+    with _slots_lock:
+        if limit not in _slots:
+            _slots[limit] = threading.BoundedSemaphore(limit)
+        return _slots[limit]
+
+
+def concurrency_limited(timeout, on_busy):
+    """Run the view only when one of ADMISSION_MAX_CONCURRENT slots frees up within `timeout` seconds.
+
+    `timeout` names a config key (or is a number); `on_busy` builds the response otherwise.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            wait = current_app.config[timeout] if isinstance(timeout, str) else timeout
+            slots = _process_slots()
+            if not slots.acquire(timeout=wait):
+                return on_busy(*args, **kwargs)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                slots.release()
+        return wrapper
+    return decorator
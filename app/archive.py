@@ -0,0 +1,250 @@
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import text
+from . import db
+from .models import Exam, Course, UserCourse, ArchivedExam
+from .responses import merge_packed
+
+# Tables whose rows belong to a single exam and move to cold storage with it
+ARCHIVED_TABLES = ['evaluation', 'response', 'packed_response', 'exam_booking', 'exam_question', 'exam_admission']
+
+
+def exam_term(exam):
+    # Two terms per year: S1 is January-June, S2 is July-December
+    return f"{exam.date_scheduled.year}_S{1 if exam.date_scheduled.month <= 6 else 2}"
+
+
+def archive_folder():
+    return os.path.join(current_app.instance_path, 'archive')
+
+
+def archive_path(term):
+    return os.path.join(archive_folder(), f"exams_{term}.db")
+
+
+def closed_exams(older_than_days):
+    """Exams that ended more than `older_than_days` ago and are not archived yet."""
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    exams = Exam.query.outerjoin(ArchivedExam, ArchivedExam.exam_id == Exam.id) \
+        .filter(ArchivedExam.exam_id == None, Exam.date_scheduled < cutoff).all()
+    return [exam for exam in exams if exam.date_scheduled + timedelta(minutes=exam.duration or 0) < cutoff]
+
+
+def _move_rows(conn, table, exam_id, batch_size):
+    # Move one exam's rows in small transactions so the write lock is never held for long
+    moved = 0
+    while True:
+        with conn.begin():
+            rowids = [rowid for (rowid,) in conn.execute(
+                text(f"SELECT rowid FROM main.{table} WHERE exam_id = :exam_id LIMIT :limit"),
+                {'exam_id': exam_id, 'limit': batch_size}
+            )]
+            if not rowids:
+                return moved
+            placeholders = ', '.join(str(rowid) for rowid in rowids)
+            conn.execute(text(f"INSERT INTO cold.{table} SELECT * FROM main.{table} WHERE rowid IN ({placeholders})"))
+            conn.execute(text(f"DELETE FROM main.{table} WHERE rowid IN ({placeholders})"))
+        moved += len(rowids)
+
+
+def archive_exams(exams, batch_size=1000):
+    """Move the per-exam rows of `exams` into per-term archive files. Returns rows moved per table."""
+    os.makedirs(archive_folder(), exist_ok=True)
+    moved = {table: 0 for table in ARCHIVED_TABLES}
+
+    by_term = {}
+    for exam in exams:
+        by_term.setdefault(exam_term(exam), []).append(exam)
+
+    for term, term_exams in by_term.items():
+        # Mark first so readers look in the archive while rows are still moving
+        for exam in term_exams:
+            db.session.add(ArchivedExam(exam_id=exam.id, term=term, archived_at=datetime.utcnow()))
+        db.session.commit()
+
+        with db.engine.connect() as conn:
+            conn.execute(text("ATTACH DATABASE :path AS cold"), {'path': archive_path(term)})
+            conn.commit()
+            try:
+                with conn.begin():
+                    for table in ARCHIVED_TABLES:
+                        # Plain copies without foreign keys: the parent tables stay in the hot database
+                        conn.execute(text(f"CREATE TABLE IF NOT EXISTS cold.{table} AS SELECT * FROM main.{table} WHERE 0"))
+                        conn.execute(text(f"CREATE INDEX IF NOT EXISTS cold.ix_{table}_exam_id ON {table} (exam_id)"))
+                for exam in term_exams:
+                    for table in ARCHIVED_TABLES:
+                        moved[table] += _move_rows(conn, table, exam.id, batch_size)
+            finally:
+                conn.execute(text("DETACH DATABASE cold"))
+                conn.commit()
+
+    return moved
+
+
+@contextmanager
+def attached_archive(term):
+    """Attach a term archive read-only to the session connection as `cold`."""
+    path = archive_path(term)
+    if not os.path.exists(path):
+        yield False
+        return
+    db.session.execute(text("ATTACH DATABASE :uri AS cold"), {'uri': f"file:{path}?mode=ro"})
+    try:
+        yield True
+    finally:
+        db.session.execute(text("DETACH DATABASE cold"))
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def archived_user_evaluations(user_id):
+    """Evaluations of `user_id` that live in archives, shaped like the rows exam_results renders."""
+    # Only open the terms that hold archived exams of courses the student is registered in
+    terms = [term for (term,) in db.session.query(ArchivedExam.term)
+             .join(Exam, Exam.id == ArchivedExam.exam_id)
+             .join(UserCourse, UserCourse.course_id == Exam.course_id)
+             .filter(UserCourse.user_id == user_id).distinct()]
+    results = []
+    for term in terms:
+        with attached_archive(term) as attached:
+            if not attached:
+                continue
+            rows = db.session.execute(text(
+                "SELECT e.exam_id, e.course_id, e.answered_count, e.corrected_count, e.grade, e.pass_or_fail, "
+                "e.submission_date, x.title, x.date_scheduled, b.booking_date "
+                "FROM cold.evaluation e "
+                "JOIN main.exam x ON x.id = e.exam_id "
+                "JOIN cold.exam_booking b ON b.exam_id = e.exam_id AND b.user_id = e.user_id "
+                "WHERE e.user_id = :user_id"
+            ), {'user_id': user_id}).all()
+        for row in rows:
+            evaluation = SimpleNamespace(
+                user_id=user_id,
+                exam_id=row.exam_id,
+                course_id=row.course_id,
+                course=db.session.get(Course, row.course_id),
+                answered_count=row.answered_count,
+                corrected_count=row.corrected_count,
+                grade=row.grade,
+                pass_or_fail=bool(row.pass_or_fail),
+                submission_date=_parse_datetime(row.submission_date)
+            )
+            results.append((evaluation, row.title, _parse_datetime(row.date_scheduled), _parse_datetime(row.booking_date)))
+    return results
+
+
+def archived_evaluation(exam_id, user_id):
+    """The student's evaluation of an archived exam, or None."""
+    archived = db.session.get(ArchivedExam, exam_id)
+    if not archived:
+        return None
+    with attached_archive(archived.term) as attached:
+        if not attached:
+            return None
+        row = db.session.execute(text(
+            "SELECT grade, pass_or_fail FROM cold.evaluation WHERE exam_id = :exam_id AND user_id = :user_id"
+        ), {'exam_id': exam_id, 'user_id': user_id}).first()
+    return SimpleNamespace(exam_id=exam_id, user_id=user_id, grade=row.grade, pass_or_fail=bool(row.pass_or_fail)) if row else None
+
+
+def archived_exam_results(exam_id):
+    """Evaluation rows of an archived exam with student details, shaped like view_results' query."""
+    archived = db.session.get(ArchivedExam, exam_id)
+    if not archived:
+        return []
+    with attached_archive(archived.term) as attached:
+        if not attached:
+            return []
+        rows = db.session.execute(text(
+            "SELECT u.first_name, u.last_name, u.email_address, e.grade, e.pass_or_fail, e.submission_date "
+            "FROM cold.evaluation e JOIN main.user u ON u.id = e.user_id "
+            "WHERE e.exam_id = :exam_id"
+        ), {'exam_id': exam_id}).all()
+    return [SimpleNamespace(
+        first_name=row.first_name,
+        last_name=row.last_name,
+        email_address=row.email_address,
+        grade=row.grade,
+        pass_or_fail=bool(row.pass_or_fail),
+        submission_date=_parse_datetime(row.submission_date)
+    ) for row in rows]
+
+
+def archived_submission(exam_id, user_id):
+    """Question ids and {question_id: answer_id} of one archived submission, or None if the exam is not archived."""
+    archived = db.session.get(ArchivedExam, exam_id)
+    if not archived:
+        return None
+    with attached_archive(archived.term) as attached:
+        if not attached:
+            return None
+        params = {'exam_id': exam_id, 'user_id': user_id}
+        question_ids = [question_id for (question_id,) in db.session.execute(text(
+            "SELECT question_id FROM cold.exam_question WHERE exam_id = :exam_id ORDER BY id"
+        ), params)]
+        responses = dict(db.session.execute(text(
+            "SELECT question_id, response FROM cold.response WHERE exam_id = :exam_id AND user_id = :user_id"
+        ), params).all())
+        packed = db.session.execute(text(
+            "SELECT answers FROM cold.packed_response WHERE exam_id = :exam_id AND user_id = :user_id"
+        ), params).scalar()
+    if packed:
+        merge_packed(responses, question_ids, packed)
+    return question_ids, responses
+
+
+def question_in_archives(question_id):
+    """Whether an archived exam lists the question; its packed answers depend on the question's position."""
+    for (term,) in db.session.query(ArchivedExam.term).distinct().all():
+        with attached_archive(term) as attached:
+            # Archive files always get every ARCHIVED_TABLES table when they are created
+            if attached and db.session.execute(text(
+                "SELECT 1 FROM cold.exam_question WHERE question_id = :question_id LIMIT 1"
+            ), {'question_id': question_id}).first():
+                return True
+    return False
+
+
+def database_report():
+    """Hot database size, per-table row counts and the latency of a results-style scan."""
+    database_path = db.engine.url.database
+    report = {'size': os.path.getsize(database_path) if os.path.exists(database_path) else 0}
+    for table in ARCHIVED_TABLES:
+        report[table] = db.session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+    start = time.perf_counter()
+    db.session.execute(text(
+        "SELECT e.exam_id, AVG(e.grade), COUNT(b.id) FROM evaluation e "
+        "LEFT JOIN exam_booking b ON b.exam_id = e.exam_id AND b.user_id = e.user_id GROUP BY e.exam_id"
+    )).all()
+    report['scan_ms'] = (time.perf_counter() - start) * 1000
+    return report
+
+
+def delete_archived_rows(exam_id):
+    """Remove an exam's rows from its archive file, when the exam itself is being purged."""
+    archived = db.session.get(ArchivedExam, exam_id)
+    if not archived or not os.path.exists(archive_path(archived.term)):
+        return 0
+    deleted = 0
+    with db.engine.connect() as conn:
+        conn.execute(text("ATTACH DATABASE :path AS cold"), {'path': archive_path(archived.term)})
+        conn.commit()
+        try:
+            with conn.begin():
+                for table in ARCHIVED_TABLES:
+                    exists = conn.execute(text("SELECT 1 FROM cold.sqlite_master WHERE type = 'table' AND name = :name"),
+                                          {'name': table}).first()
+                    if exists:
+                        deleted += conn.execute(text(f"DELETE FROM cold.{table} WHERE exam_id = :exam_id"),
+                                                {'exam_id': exam_id}).rowcount
+        finally:
+            conn.execute(text("DETACH DATABASE cold"))
+            conn.commit()
+    return deleted
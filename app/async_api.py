@@ -0,0 +1,144 @@
+"""ASGI front for the small, frequent JSON endpoints.
+
+The review fetch in exam_results.html and the waiting-room poll spend most of their
+time waiting on SQLite. Served by AsyncJsonApp they run on an event loop with an
+aiosqlite-backed AsyncSession over the same models, so one worker keeps hundreds of
+them in flight instead of one per thread. Every other path is handed to the Flask
+app unchanged. See asgi.py.
+"""
+import asyncio
+import json
+import re
+from http.cookies import SimpleCookie
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from . import db
+from .models import User, PackedResponse, ExamAdmission, AdmissionControl, ArchivedExam
+from .responses import (exam_question_ids_query, user_responses_query, review_questions_query, review_answers_query,
+                        merge_packed, group_answers, build_review, submission_review)
+from .admission import exam_limits, available_tokens, queue_position_query, waiting_status, queue_status
+
+
+class AsyncJsonApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.prefix = flask_app.config['ASYNC_JSON_PREFIX']
+        self.routes = [
+            (re.compile(r'^/exam_questions_answers/(\d+)$'), self.exam_questions_answers),
+            (re.compile(r'^/exam_status/(\d+)$'), self.exam_status),
+        ]
+
+        # Same database file as the Flask app, through the aiosqlite driver
+        with flask_app.app_context():
+            url = db.engine.url.set(drivername='sqlite+aiosqlite')
+        self.engine = create_async_engine(url)
+        event.listen(self.engine.sync_engine, 'connect', _enable_foreign_keys)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+        # Flask-Login keeps the user id in Flask's signed session cookie
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['path'].startswith(self.prefix + '/'):
+            path = scope['path'][len(self.prefix):]
+            for pattern, handler in self.routes:
+                match = pattern.match(path)
+                if match:
+                    if scope['method'] != 'GET':
+                        return await respond(send, {'error': 'Method Not Allowed'}, 405)
+                    return await self.dispatch(scope, send, handler, int(match.group(1)))
+            return await respond(send, {'error': 'Not Found'}, 404)
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, scope, send, handler, object_id):
+        async with self.sessions() as session:
+            user = await self.current_user(scope, session)
+            if user is None:
+                return await respond(send, {'error': 'Login required'}, 401)
+            data, status = await handler(session, user, object_id)
+        return await respond(send, data, status)
+
+    async def current_user(self, scope, session):
+        cookies = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        cookie = cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if cookie is None or self.serializer is None:
+            return None
+        try:
+            flask_session = self.serializer.loads(
+                cookie.value, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        user_id = flask_session.get('_user_id')
+        return await session.get(User, int(user_id)) if user_id else None
+
+    async def exam_questions_answers(self, session, user, exam_id):
+        # Same statements and JSON as responses.submission_review, in four queries instead of two per question
+        question_ids = (await session.scalars(exam_question_ids_query(exam_id))).all()
+        if not question_ids and await session.get(ArchivedExam, exam_id):
+            # Archived exams are read from their term file, through the sync archive code
+            return await asyncio.to_thread(self.sync_submission_review, exam_id, user.id), 200
+
+        user_responses = dict((await session.execute(user_responses_query(exam_id, user.id))).all())
+        packed = await session.get(PackedResponse, (exam_id, user.id))
+        if packed:
+            merge_packed(user_responses, question_ids, packed.answers)
+
+        questions = dict((await session.execute(review_questions_query(question_ids))).all())
+        answers = group_answers(await session.scalars(review_answers_query(question_ids)))
+        return build_review(question_ids, user_responses, questions, answers), 200
+
+    async def exam_status(self, session, user, exam_id):
+        # The common case, a student waiting further back in the queue, is answered without writes
+        admission = await session.get(ExamAdmission, (exam_id, user.id))
+        if admission is None:
+            return {'admitted': False, 'queued': False}, 200
+        if admission.admitted_at:
+            return {'admitted': True, 'queued': True}, 200
+
+        # Same decision as admission.queue_status: admitting writes, so it runs in the sync code
+        control = await session.get(AdmissionControl, exam_id)
+        if available_tokens(control, self.flask_app.config) >= 1:
+            return await asyncio.to_thread(self.sync_queue_status, exam_id, user.id), 200
+        rate, burst = exam_limits(control, self.flask_app.config)
+        return waiting_status(await session.scalar(queue_position_query(admission)), rate), 200
+
+    def sync_submission_review(self, exam_id, user_id):
+        with self.flask_app.app_context():
+            return submission_review(exam_id, user_id)
+
+    def sync_queue_status(self, exam_id, user_id):
+        with self.flask_app.app_context():
+            return queue_status(exam_id, user_id)
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+async def respond(send, data, status=200):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('ascii')),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,37 @@
+import time
+from datetime import date
+from types import SimpleNamespace
+from flask import current_app
+from . import db
+from .models import Course, Exam
+
+# Shared by every request in this process: {'date': ..., 'built_at': ..., 'courses': [...]}
+_catalog = {}
+
+
+def upcoming_catalog():
+    """Courses with at least one upcoming exam and how many, identical for every student.
+
+    Cached per day. Views that change courses or exams call invalidate_catalog();
+    CATALOG_CACHE_SECONDS bounds staleness for changes made by other processes.
+    """
+    today = date.today()
+    max_age = current_app.config['CATALOG_CACHE_SECONDS']
+    cached = _catalog.get('entry')
+    if cached and cached['date'] == today and time.monotonic() - cached['built_at'] < max_age:
+        return cached['courses']
+
+    rows = db.session.query(Course.id, Course.name, Course.description, db.func.count(Exam.id)) \
+        .join(Exam, Exam.course_id == Course.id) \
+        .filter(Exam.date_scheduled >= today) \
+        .group_by(Course.id).order_by(Course.name).all()
+    # Plain objects so the cache never holds ORM instances bound to a finished session
+    courses = [SimpleNamespace(id=course_id, name=name, description=description, upcoming_exams=count)
+               for course_id, name, description, count in rows]
+
+    _catalog['entry'] = {'date': today, 'built_at': time.monotonic(), 'courses': courses}
+    return courses
+
+
+def invalidate_catalog():
+    _catalog.pop('entry', None)
@@ -0,0 +1,326 @@
+import asyncio
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+import click
+from flask import current_app as app
+from sqlalchemy import text
+from . import db
+from .models import Exam, Answer, Course, Question, Response, PackedResponse
+from .responses import pack_exam_responses, iter_exam_responses, get_user_responses, exam_question_ids
+from .archive import closed_exams, archive_exams, database_report, ARCHIVED_TABLES
+from .search import ensure_search_index, rebuild_search_index
+from .dedupe import index_missing, duplicate_clusters
+from .admission import admission_control
+from .scheduler import run_scheduler_once, run_scheduler_forever
+from .statistics import rebuild_score_distributions
+from .purge import purge_exam, purge_course
+from .profiler import issue_token
+
+
+def table_sizes(*names):
+    # On-disk bytes per table/index, read from SQLite's dbstat virtual table
+    rows = db.session.execute(text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).all()
+    sizes = dict(rows)
+    return {name: sizes.get(name, 0) for name in names}
+
+
+@app.cli.command('pack-responses')
+@click.option('--exam-id', type=int, default=None, help='Only convert this exam.')
+def pack_responses_command(exam_id):
+    """Convert Response rows into one PackedResponse row per submission."""
+    exam_ids = [exam_id] if exam_id else [
+        exam_id for (exam_id,) in db.session.query(Response.exam_id).distinct()
+    ]
+    total = 0
+    for exam_id in exam_ids:
+        converted = pack_exam_responses(exam_id)
+        click.echo(f"Exam {exam_id}: packed {converted} submissions")
+        total += converted
+    click.echo(f"Packed {total} submissions from {len(exam_ids)} exams")
+
+
+@app.cli.command('responses-report')
+def responses_report_command():
+    """Report storage used by responses and how long grading/review reads take."""
+    sizes = table_sizes('response', 'sqlite_autoindex_response_1',
+                        'packed_response', 'sqlite_autoindex_packed_response_1')
+    click.echo(f"Response rows:       {Response.query.count():>10}  "
+               f"{sizes['response'] + sizes['sqlite_autoindex_response_1']:>12} bytes")
+    click.echo(f"PackedResponse rows: {PackedResponse.query.count():>10}  "
+               f"{sizes['packed_response'] + sizes['sqlite_autoindex_packed_response_1']:>12} bytes")
+
+    exam_ids = [exam_id for (exam_id,) in db.session.query(Exam.id)]
+    correct_ids = {answer_id for (answer_id,) in db.session.query(Answer.id).filter(Answer.is_correct == True)}
+
+    # Grading: score every stored answer of every exam against the answer key
+    start = time.perf_counter()
+    answers = correct = 0
+    for exam_id in exam_ids:
+        for _, _, answer_id in iter_exam_responses(exam_id):
+            answers += 1
+            correct += answer_id in correct_ids
+    grading = time.perf_counter() - start
+    click.echo(f"Grading:  {answers} answers ({correct} correct) in {grading * 1000:.1f} ms")
+
+    # Review: load each submission the way exam_questions_answers does
+    submissions = set(db.session.query(Response.exam_id, Response.user_id).distinct())
+    submissions.update(db.session.query(PackedResponse.exam_id, PackedResponse.user_id))
+    start = time.perf_counter()
+    for exam_id, user_id in submissions:
+        get_user_responses(exam_id, user_id, exam_question_ids(exam_id))
+    review = time.perf_counter() - start
+    per_submission = review * 1000 / len(submissions) if submissions else 0
+    click.echo(f"Review:   {len(submissions)} submissions in {review * 1000:.1f} ms "
+               f"({per_submission:.2f} ms each)")
+
+
+def echo_database_report(label, report):
+    click.echo(f"{label}: {report['size'] / 1024:.0f} KiB, results scan {report['scan_ms']:.1f} ms")
+    for table in ARCHIVED_TABLES:
+        click.echo(f"  {table:<16} {report[table]:>10} rows")
+
+
+@app.cli.command('archive-exams')
+@click.option('--older-than-days', type=int, default=None, help='Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--vacuum', is_flag=True, help='VACUUM the hot database afterwards to reclaim space.')
+def archive_exams_command(older_than_days, vacuum):
+    """Move rows of long-finished exams into per-term archive files."""
+    if older_than_days is None:
+        older_than_days = app.config['ARCHIVE_AFTER_DAYS']
+
+    echo_database_report('Before', database_report())
+    exams = closed_exams(older_than_days)
+    moved = archive_exams(exams, app.config['ARCHIVE_BATCH_SIZE'])
+    click.echo(f"Archived {len(exams)} exams ({sum(moved.values())} rows)")
+
+    if vacuum:
+        db.session.commit()  # VACUUM cannot run inside a transaction
+        db.session.execute(text('VACUUM'))
+    echo_database_report('After', database_report())
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Recreate the question full-text index from the Question and Answer tables."""
+    if not ensure_search_index():
+        click.echo("This SQLite build has no FTS5 support; search falls back to LIKE")
+        return
+    start = time.perf_counter()
+    indexed = rebuild_search_index()
+    click.echo(f"Indexed {indexed} questions in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+@app.cli.command('dedupe-report')
+@click.option('--course-id', type=int, default=None, help='Only report this course.')
+@click.option('--threshold', type=float, default=None, help='Defaults to DUPLICATE_THRESHOLD.')
+def dedupe_report_command(course_id, threshold):
+    """List groups of near-duplicate questions per course."""
+    indexed = index_missing(course_id)
+    if indexed:
+        click.echo(f"Computed signatures for {indexed} questions")
+
+    courses = [db.session.get(Course, course_id)] if course_id else Course.query.all()
+    for course in courses:
+        if course is None:
+            continue
+        clusters = duplicate_clusters(course.id, threshold)
+        click.echo(f"Course {course.id} ({course.name}): {len(clusters)} duplicate groups")
+        for cluster in clusters:
+            questions = Question.query.filter(Question.id.in_(cluster)).all()
+            click.echo(f"  {len(questions)} questions:")
+            for question in questions:
+                click.echo(f"    [{question.id}] {question.question_text}")
+
+
+@app.cli.command('admission-limit')
+@click.argument('exam_id', type=int)
+@click.option('--rate', type=float, default=None, help='Students admitted per second.')
+@click.option('--burst', type=int, default=None, help='Students admitted at once when the exam opens.')
+def admission_limit_command(exam_id, rate, burst):
+    """Set the waiting-room limits of one exam; omitted options use the configured defaults."""
+    if db.session.get(Exam, exam_id) is None:
+        raise click.BadParameter(f"Exam {exam_id} does not exist", param_hint='EXAM_ID')
+    control = admission_control(exam_id)
+    control.rate_per_second = rate
+    control.burst = burst
+    db.session.commit()
+    click.echo(f"Exam {exam_id}: {rate or app.config['ADMISSION_RATE']} students/s, "
+               f"burst {burst or app.config['ADMISSION_BURST']}")
+
+
+@app.cli.command('run-scheduler')
+@click.option('--once', is_flag=True, help='Run the due jobs once and exit.')
+def run_scheduler_command(once):
+    """Run the exam scheduler as a separate worker process."""
+    real_app = app._get_current_object()
+    if once:
+        ran = run_scheduler_once(real_app)
+        click.echo(f"Ran {ran} scheduled jobs")
+    else:
+        run_scheduler_forever(real_app)
+
+
+@app.cli.command('rebuild-distributions')
+def rebuild_distributions_command():
+    """Recount the per-exam score distributions from the Evaluation table."""
+    exams = rebuild_score_distributions()
+    click.echo(f"Rebuilt score distributions of {exams} exams")
+
+
+def echo_purge_counts(counts):
+    for table, deleted in sorted(counts.items()):
+        if deleted:
+            click.echo(f"  {table:<20} {deleted:>10} rows")
+
+
+@app.cli.command('purge-exam')
+@click.argument('exam_id', type=int)
+@click.confirmation_option(prompt='Delete this exam with all its bookings, responses and results?')
+def purge_exam_command(exam_id):
+    """Delete an exam and all its rows in bounded batches."""
+    if db.session.get(Exam, exam_id) is None:
+        raise click.BadParameter(f"Exam {exam_id} does not exist", param_hint='EXAM_ID')
+    counts = purge_exam(exam_id, app.config['PURGE_BATCH_SIZE'])
+    click.echo(f"Purged exam {exam_id}")
+    echo_purge_counts(counts)
+
+
+@app.cli.command('purge-course')
+@click.argument('course_id', type=int)
+@click.confirmation_option(prompt='Delete this course with its exams, questions and results?')
+def purge_course_command(course_id):
+    """Delete a course, its exams and its question bank in bounded batches."""
+    if db.session.get(Course, course_id) is None:
+        raise click.BadParameter(f"Course {course_id} does not exist", param_hint='COURSE_ID')
+    counts = purge_course(course_id, app.config['PURGE_BATCH_SIZE'])
+    click.echo(f"Purged course {course_id}")
+    echo_purge_counts(counts)
+
+
+@app.cli.command('profile-token')
+@click.option('--label', default='admin', help='Recorded in the token, e.g. who it was issued to.')
+def profile_token_command(label):
+    """Print a token that turns on profiling for the requests carrying it."""
+    if not app.config['PROFILE_SECRET']:
+        raise click.ClickException("Set the PROFILE_SECRET environment variable first")
+    click.echo(issue_token(label))
+    click.echo(f"Valid for {app.config['PROFILE_TOKEN_MAX_AGE'] // 60} minutes", err=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def uvicorn_server(target, interface, port, workers, env):
+    """Run `target` under uvicorn in a child process until the block exits."""
+    root = os.path.dirname(app.root_path)
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', target, '--interface', interface,
+                                '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+                               cwd=root, env=env, stdout=sys.stderr)  # Keep server logs out of the results table
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise click.ClickException(f"uvicorn {target} did not start")
+                time.sleep(0.2)
+        yield
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+async def http_load(port, path, cookie, count, concurrency):
+    """Send `count` GETs over `concurrency` keep-alive connections. Returns latencies, errors and seconds."""
+    request = (f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nCookie: {cookie}\r\n"
+               f"Connection: keep-alive\r\n\r\n").encode('latin-1')
+    remaining = [count]
+    latencies = []
+    errors = [0]
+
+    async def connection():
+        reader = writer = None
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request)
+                await writer.drain()
+                head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+                headers = dict(line.lower().split(': ', 1) for line in head[1:] if ': ' in line)
+                await reader.readexactly(int(headers['content-length']))
+                if head[0].split()[1] != '200':
+                    errors[0] += 1
+                if headers.get('connection') == 'close':
+                    writer.close()
+                    writer = None
+            except (OSError, KeyError, asyncio.IncompleteReadError):
+                errors[0] += 1
+                if writer is not None:
+                    writer.close()
+                writer = None
+                continue
+            latencies.append(time.perf_counter() - started)
+        if writer is not None:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(concurrency)))
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def latency_ms(latencies, quantile):
+    ordered = sorted(latencies)
+    return ordered[int(quantile * (len(ordered) - 1))] * 1000 if ordered else 0
+
+
+@app.cli.command('bench-json')
+@click.argument('exam_id', type=int)
+@click.argument('user_id', type=int)
+@click.option('--requests', 'count', type=int, default=2000, help='Requests per endpoint and server.')
+@click.option('--concurrency', type=int, default=50, help='Open client connections, each sending one request at a time.')
+@click.option('--workers', type=int, default=1, help='uvicorn worker processes of each server.')
+def bench_json_command(exam_id, user_id, count, concurrency, workers):
+    """Load-test the JSON endpoints over HTTP: asgi.py's async endpoints against Flask under WSGI.
+
+    Both servers are uvicorn with the same number of workers: asgi:application serving
+    /async/..., and application:application with --interface wsgi (a thread pool per worker).
+    """
+    # Servers and client must share the session key to accept the benchmark's login cookie
+    secret = os.environ.get('SECRET_KEY') or secrets.token_hex(24)
+    env = dict(os.environ, SECRET_KEY=secret)
+    real_app = app._get_current_object()
+    real_app.secret_key = secret
+    session_value = real_app.session_interface.get_signing_serializer(real_app) \
+        .dumps({'_user_id': str(user_id), '_fresh': True})
+    cookie = f"{real_app.config['SESSION_COOKIE_NAME']}={session_value}"
+    paths = [f'/exam_questions_answers/{exam_id}', f'/exam_status/{exam_id}']
+    servers = [('async', 'asgi:application', 'asgi3', real_app.config['ASYNC_JSON_PREFIX']),
+               ('wsgi', 'application:application', 'wsgi', '')]
+
+    click.echo(f"{count} requests per run, {concurrency} connections, {workers} worker(s) per server")
+    click.echo(f"{'endpoint':<24} {'server':<7} {'req/s':>8} {'per worker':>11} "
+               f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for server, target, interface, prefix in servers:
+        port = free_port()
+        with uvicorn_server(target, interface, port, workers, env):
+            for path in paths:
+                asyncio.run(http_load(port, prefix + path, cookie, concurrency, concurrency))  # Warm-up
+                latencies, errors, elapsed = asyncio.run(http_load(port, prefix + path, cookie, count, concurrency))
+                throughput = len(latencies) / elapsed
+                click.echo(f"{path.split('/')[1]:<24} {server:<7} {throughput:>8.0f} {throughput / workers:>11.0f} "
+                           f"{latency_ms(latencies, 0.5):>8.1f} {latency_ms(latencies, 0.95):>8.1f} "
+                           f"{latency_ms(latencies, 0.99):>8.1f} {errors:>7}")
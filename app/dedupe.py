@@ -0,0 +1,161 @@
+import random
+import re
+import struct
+import zlib
+from flask import current_app
+from . import db
+from .models import Question, QuestionSignature, QuestionBucket
+
+# 64 MinHash values split into 16 LSH bands of 4 rows: questions sharing any band
+# bucket become candidates, which finds pairs above ~0.7 Jaccard similarity with high probability
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 4
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20241103)  # Fixed seed: stored signatures must stay comparable across restarts
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def shingles(question_text):
+    # Character shingles of the normalized text, so small wording edits keep most shingles
+    normalized = ' '.join(re.findall(r'\w+', question_text.lower()))
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def minhash(question_text):
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(question_text)]
+    return [min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def band_buckets(signature):
+    # One bucket id per band: a hash of that band's slice of the signature
+    return [
+        (band, zlib.crc32(struct.pack(f'<{ROWS_PER_BAND}I', *signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])))
+        for band in range(BANDS)
+    ]
+
+
+def similarity(signature, other):
+    # Fraction of agreeing MinHash values estimates the Jaccard similarity of the shingle sets
+    return sum(1 for a, b in zip(signature, other) if a == b) / NUM_PERMUTATIONS
+
+
+def pack_signature(signature):
+    return struct.pack(f'<{NUM_PERMUTATIONS}I', *signature)
+
+
+def unpack_signature(data):
+    return list(struct.unpack(f'<{NUM_PERMUTATIONS}I', data))
+
+
+def index_question(question):
+    """Store the MinHash signature and LSH buckets of `question`, replacing older ones."""
+    unindex_question(question.id)
+    signature = minhash(question.question_text)
+    db.session.add(QuestionSignature(question_id=question.id, signature=pack_signature(signature)))
+    db.session.add_all(QuestionBucket(band=band, bucket=bucket, question_id=question.id)
+                       for band, bucket in band_buckets(signature))
+
+
+def unindex_question(question_id):
+    QuestionBucket.query.filter_by(question_id=question_id).delete(synchronize_session=False)
+    QuestionSignature.query.filter_by(question_id=question_id).delete(synchronize_session=False)
+
+
+def find_duplicates(question_text, course_id=None, exclude_id=None, threshold=None):
+    """Indexed questions similar to `question_text`, most similar first, as (question, similarity)."""
+    if threshold is None:
+        threshold = current_app.config['DUPLICATE_THRESHOLD']
+    signature = minhash(question_text)
+
+    # Candidates share at least one band bucket; only those signatures are compared
+    bucket_filter = db.or_(*[
+        db.and_(QuestionBucket.band == band, QuestionBucket.bucket == bucket)
+        for band, bucket in band_buckets(signature)
+    ])
+    query = db.session.query(QuestionSignature, Question) \
+        .join(Question, Question.id == QuestionSignature.question_id) \
+        .filter(QuestionSignature.question_id.in_(
+            db.session.query(QuestionBucket.question_id).filter(bucket_filter)
+        ))
+    if course_id is not None:
+        query = query.filter(Question.course_id == course_id)
+    if exclude_id is not None:
+        query = query.filter(Question.id != exclude_id)
+
+    matches = []
+    for stored, question in query:
+        score = similarity(signature, unpack_signature(stored.signature))
+        if score >= threshold:
+            matches.append((question, score))
+    matches.sort(key=lambda match: match[1], reverse=True)
+    return matches
+
+
+def index_missing(course_id=None):
+    """Sign questions added before duplicate detection existed. Returns how many were indexed."""
+    query = Question.query.outerjoin(QuestionSignature, QuestionSignature.question_id == Question.id) \
+        .filter(QuestionSignature.question_id == None)
+    if course_id is not None:
+        query = query.filter(Question.course_id == course_id)
+    questions = query.all()
+    for question in questions:
+        index_question(question)
+    db.session.commit()
+    return len(questions)
+
+
+def ensure_duplicate_index():
+    # Questions added before duplicate detection (or outside the app) are signed on start,
+    # so add_question flags copies of them straight away
+    return index_missing()
+
+
+def duplicate_clusters(course_id, threshold=None):
+    """Groups of near-duplicate question ids within a course, largest first."""
+    if threshold is None:
+        threshold = current_app.config['DUPLICATE_THRESHOLD']
+
+    signatures = {
+        question_id: unpack_signature(signature)
+        for question_id, signature in db.session.query(QuestionSignature.question_id, QuestionSignature.signature)
+        .join(Question, Question.id == QuestionSignature.question_id)
+        .filter(Question.course_id == course_id)
+    }
+
+    # Group by bucket instead of comparing every pair of questions
+    buckets = {}
+    for question_id, band, bucket in db.session.query(
+            QuestionBucket.question_id, QuestionBucket.band, QuestionBucket.bucket) \
+            .join(Question, Question.id == QuestionBucket.question_id) \
+            .filter(Question.course_id == course_id):
+        buckets.setdefault((band, bucket), []).append(question_id)
+
+    parent = {question_id: question_id for question_id in signatures}
+
+    def find(question_id):
+        while parent[question_id] != question_id:
+            parent[question_id] = parent[parent[question_id]]
+            question_id = parent[question_id]
+        return question_id
+
+    checked = set()
+    for members in buckets.values():
+        for i, first in enumerate(members):
+            for second in members[i + 1:]:
+                pair = (min(first, second), max(first, second))
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if similarity(signatures[first], signatures[second]) >= threshold:
+                    parent[find(first)] = find(second)
+
+    clusters = {}
+    for question_id in signatures:
+        clusters.setdefault(find(question_id), []).append(question_id)
+    return sorted((sorted(ids) for ids in clusters.values() if len(ids) > 1), key=len, reverse=True)
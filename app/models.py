@@ -17,22 +17,22 @@ class User(db.Model, UserMixin):
 
 
 class Response(db.Model):
-    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), primary_key=True)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='RESTRICT'), primary_key=True, index=True)  # Answered questions cannot be deleted
     response = db.Column(db.Integer, nullable=False)
 
 class UserCourse(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), primary_key=True, index=True)
 
     user = db.relationship('User', backref='courses')  # Access user's courses
-    course = db.relationship('Course', backref='students')  # Access students in a course
+    course = db.relationship('Course', backref=db.backref('students', passive_deletes='all'))  # Access students in a course
 
 class Evaluation(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), primary_key=True)
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True, index=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), nullable=False, index=True)
     answered_count = db.Column(db.Integer, nullable=False)
     corrected_count = db.Column(db.Integer, nullable=False)
     grade = db.Column(db.Integer, nullable=False)
@@ -40,8 +40,8 @@ class Evaluation(db.Model):
     submission_date = db.Column(db.DateTime, nullable=True)  # Add submission date
 
     # Relationships for easy access in the template
-    exam = db.relationship('Exam', backref='evaluations')
-    course = db.relationship('Course', backref='evaluations')
+    exam = db.relationship('Exam', backref=db.backref('evaluations', passive_deletes='all'))
+    course = db.relationship('Course', backref=db.backref('evaluations', passive_deletes='all'))
 
 
 class Course(db.Model):
@@ -49,22 +49,22 @@ class Course(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(500))
     teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # Teacher who created the course
-    questions = db.relationship('Question', backref='course', lazy=True)  # Link questions to courses
+    questions = db.relationship('Question', backref='course', lazy=True, cascade='all, delete-orphan', passive_deletes=True)  # Link questions to courses
 
 # Question model
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     question_text = db.Column(db.String(500), nullable=False)
     difficulty = db.Column(db.String(10), nullable=False)  # 'easy', 'medium', 'hard'
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'))  # Associate with course
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), index=True)  # Associate with course
     added_by = db.Column(db.Integer, db.ForeignKey('user.id'))  # Teacher who added the question
-    answers = db.relationship('Answer', backref='question', lazy=True, cascade='all, delete-orphan')  # Cascade delete
+    answers = db.relationship('Answer', backref='question', lazy=True, cascade='all, delete-orphan', passive_deletes=True)  # Cascade delete in the database
 
 # Answer model
 class Answer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     answer_text = db.Column(db.String(200), nullable=False)
-    question_id = db.Column(db.Integer, db.ForeignKey('question.id'))  # Link to question
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='CASCADE'), index=True)  # Link to question
     is_correct = db.Column(db.Boolean, default=False)  # Indicates if this is the correct answer
 
 
@@ -72,7 +72,7 @@ class Exam(db.Model):
     # __tablename__ = 'exam'  # Optional but a good practice
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), nullable=False, index=True)
     number_of_questions = db.Column(db.Integer, nullable=False)
     passing_grade = db.Column(db.Integer, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -80,24 +80,113 @@ class Exam(db.Model):
     duration = db.Column(db.Integer)  # Duration in minutes
 
     # Define relationship without conflicting backref
-    exam_questions = db.relationship('ExamQuestion', backref='exam_instance', lazy=True)  # Changed to avoid name conflict
+    exam_questions = db.relationship('ExamQuestion', backref='exam_instance', lazy=True, cascade='all, delete-orphan', passive_deletes=True)  # Changed to avoid name conflict
 
 
 class ExamQuestion(db.Model):
     # __tablename__ = 'exam_question'  # Optional but a good practice
     id = db.Column(db.Integer, primary_key=True)
-    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), nullable=False)
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)  # Add course_id as a foreign key
-    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), nullable=False, index=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id', ondelete='CASCADE'), nullable=False, index=True)  # Add course_id as a foreign key
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='RESTRICT'), nullable=False, index=True)  # Packed answers are stored by position in this table
 
     # Define relationships
-    exam = db.relationship('Exam', backref='exam_questions_rel', lazy=True)  # Keep this to access the exam from the question
-    question = db.relationship('Question', backref=db.backref('exam_questions', lazy=True))
-    course = db.relationship('Course', backref=db.backref('exam_questions', lazy=True))  # Add relationship to Course
+    exam = db.relationship('Exam', backref=db.backref('exam_questions_rel', passive_deletes='all'), lazy=True)  # Keep this to access the exam from the question
+    question = db.relationship('Question', backref=db.backref('exam_questions', lazy=True, passive_deletes='all'))
+    course = db.relationship('Course', backref=db.backref('exam_questions', lazy=True, passive_deletes='all'))  # Add relationship to Course
 
 
 class ExamBooking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id'), nullable=False)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    booking_date = db.Column(db.DateTime, default=datetime.utcnow())
\ No newline at end of file
+    booking_date = db.Column(db.DateTime, default=datetime.utcnow())
+
+class PackedResponse(db.Model):
+    # One row per submission instead of one Response row per question
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    answers = db.Column(db.LargeBinary, nullable=False)  # Answer ids in ExamQuestion order, 0 means unanswered
+
+
+class ArchivedExam(db.Model):
+    # Exams whose per-exam rows were moved to a cold-storage archive file
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    term = db.Column(db.String(10), nullable=False)  # Archive file the rows live in, e.g. '2024_S2'
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+
+class QuestionSignature(db.Model):
+    # MinHash signature of a question's text, used for near-duplicate detection
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='CASCADE'), primary_key=True)
+    signature = db.Column(db.LargeBinary, nullable=False)  # Little-endian uint32 values
+
+
+class QuestionBucket(db.Model):
+    # LSH index: questions sharing a (band, bucket) pair are duplicate candidates
+    band = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+
+class ExamAdmission(db.Model):
+    # Waiting-room ticket of a student entering an exam
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    queued_at = db.Column(db.DateTime, nullable=False)
+    admitted_at = db.Column(db.DateTime, nullable=True)  # None while the student is still waiting
+
+    __table_args__ = (db.Index('ix_exam_admission_queue', 'exam_id', 'admitted_at', 'queued_at'),)
+
+
+class AdmissionControl(db.Model):
+    # Token bucket admitting students into an exam, with optional per-exam limits
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    rate_per_second = db.Column(db.Float, nullable=True)  # None means ADMISSION_RATE
+    burst = db.Column(db.Integer, nullable=True)  # None means ADMISSION_BURST
+    tokens = db.Column(db.Float, nullable=False)
+    refilled_at = db.Column(db.DateTime, nullable=False)
+
+
+class ScheduledJob(db.Model):
+    # Work the scheduler does around an exam's date_scheduled, persisted so it survives restarts
+    id = db.Column(db.Integer, primary_key=True)
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'prewarm' or 'finalize'
+    run_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, running, done, failed, skipped
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('exam_id', 'kind'),
+        db.Index('ix_scheduled_job_due', 'status', 'run_at'),
+    )
+
+
+class ExamPaper(db.Model):
+    # Compiled paper and answer key of an exam, shared by every process; token changes on each compile
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    token = db.Column(db.String(32), nullable=False)
+    paper = db.Column(db.Text, nullable=False)  # JSON list of questions with their answers
+    answer_key = db.Column(db.Text, nullable=False)  # JSON {question_id: correct answer id}
+    compiled_at = db.Column(db.DateTime, nullable=False)
+
+
+class ExamStatistics(db.Model):
+    # Aggregate results of a finished exam, computed once by the scheduler
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    registered_count = db.Column(db.Integer, nullable=False)
+    taken_count = db.Column(db.Integer, nullable=False)
+    passed_count = db.Column(db.Integer, nullable=False)
+    average_grade = db.Column(db.Float, nullable=True)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+
+class ScoreBucket(db.Model):
+    # Score distribution of an exam: how many evaluations fall on each whole grade 0-100
+    exam_id = db.Column(db.Integer, db.ForeignKey('exam.id', ondelete='CASCADE'), primary_key=True)
+    grade = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,104 @@
+import json
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import Question, Answer, ExamQuestion, ExamPaper
+from .responses import exam_question_ids
+
+# Compiled papers live in the exam_paper table, shared by web workers and the scheduler.
+# Each process also keeps them in memory, keyed by exam id, and uses its copy only while
+# the row's token still matches: one primary-key read instead of recompiling, and an
+# edit made in any process is seen by all of them on their next read.
+_papers = {}
+
+
+def _remember(exam_id, value):
+    # Drop the oldest entries once the cache is full; dicts keep insertion order
+    _papers.pop(exam_id, None)
+    while len(_papers) >= current_app.config['PAPER_CACHE_SIZE']:
+        _papers.pop(next(iter(_papers)))
+    _papers[exam_id] = value
+    return value
+
+
+def _compile(exam_id):
+    question_ids = exam_question_ids(exam_id)
+    questions = {question.id: question for question in Question.query.filter(Question.id.in_(question_ids))}
+    answers = {}
+    for answer in Answer.query.filter(Answer.question_id.in_(question_ids)).order_by(Answer.id):
+        answers.setdefault(answer.question_id, []).append(answer)
+
+    paper = [
+        {'id': question_id,
+         'question_text': questions[question_id].question_text,
+         'answers': [{'id': answer.id, 'answer_text': answer.answer_text} for answer in answers.get(question_id, [])]}
+        for question_id in question_ids if question_id in questions
+    ]
+    answer_key = {question_id: answer.id
+                  for question_id, question_answers in answers.items()
+                  for answer in question_answers if answer.is_correct}
+    return paper, answer_key
+
+
+def _decode(row):
+    # Plain objects so cached papers never hold ORM instances bound to a finished session
+    paper = [SimpleNamespace(id=question['id'], question_text=question['question_text'],
+                             answers=[SimpleNamespace(**answer) for answer in question['answers']])
+             for question in json.loads(row.paper)]
+    answer_key = {int(question_id): answer_id for question_id, answer_id in json.loads(row.answer_key).items()}
+    return SimpleNamespace(token=row.token, paper=paper, answer_key=answer_key)
+
+
+def _load(exam_id):
+    token = db.session.query(ExamPaper.token).filter(ExamPaper.exam_id == exam_id).scalar()
+    cached = _papers.get(exam_id)
+    if cached and cached.token == token:
+        return cached
+
+    if token is None:
+        paper, answer_key = _compile(exam_id)
+        # Processes compiling at the same time keep whichever row was stored first
+        db.session.execute(sqlite_insert(ExamPaper).values(
+            exam_id=exam_id, token=uuid.uuid4().hex, paper=json.dumps(paper),
+            answer_key=json.dumps(answer_key), compiled_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['exam_id']))
+        db.session.commit()
+    row = db.session.get(ExamPaper, exam_id, populate_existing=True)
+    return _remember(exam_id, _decode(row))
+
+
+def exam_paper(exam_id):
+    """Questions of an exam in order, each with its answers, as rendered by take_exam."""
+    return _load(exam_id).paper
+
+
+def answer_key(exam_id):
+    """{question_id: correct answer id} for an exam, checked against the stored paper on every call."""
+    return _load(exam_id).answer_key
+
+
+def warm_exam(exam_id):
+    """Compile and store the paper and answer key, and read the booking list into the OS page cache."""
+    _load(exam_id)
+    return db.session.execute(text("SELECT COUNT(user_id) FROM exam_booking WHERE exam_id = :exam_id"),
+                              {'exam_id': exam_id}).scalar()
+
+
+def forget_exam(exam_id):
+    """Drop the exam's compiled paper in every process; the next read compiles it again."""
+    ExamPaper.query.filter_by(exam_id=exam_id).delete(synchronize_session=False)
+    db.session.commit()
+    _papers.pop(exam_id, None)
+
+
+def invalidate_papers(question_id):
+    """A question or its answers changed: drop the papers of the exams that use it."""
+    exam_ids = db.session.query(ExamQuestion.exam_id).filter(ExamQuestion.question_id == question_id)
+    ExamPaper.query.filter(ExamPaper.exam_id.in_(exam_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    for (exam_id,) in exam_ids:
+        _papers.pop(exam_id, None)
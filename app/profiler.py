@@ -0,0 +1,198 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlencode
+from flask import current_app, g, has_app_context, request
+from flask_login import current_user
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Profiles are written as collapsed stacks ("root;caller;callee count" per line), the
+# input format of flamegraph.pl and speedscope, next to a JSON file with the request
+# details and the SQL statements it ran.
+PROFILE_HEADER = 'X-Profile-Token'
+PROFILE_ARG = 'profile'
+UNPROFILED_ENDPOINTS = {'static', 'profiles', 'profile_file'}
+
+
+def profiles_folder():
+    return os.path.join(current_app.instance_path, 'profiles')
+
+
+def token_serializer():
+    return URLSafeTimedSerializer(current_app.config['PROFILE_SECRET'], salt='request-profile')
+
+
+def issue_token(label):
+    return token_serializer().dumps(label)
+
+
+def valid_token(token):
+    if not token or not current_app.config['PROFILE_SECRET']:
+        return False
+    try:
+        token_serializer().loads(token, max_age=current_app.config['PROFILE_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    return True
+
+
+def request_token():
+    return request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_ARG)
+
+
+class StackSampler:
+    """Samples the call stack of one thread from a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapsed_stack(frame)] += 1
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def collapsed_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def should_profile():
+    if request.endpoint is None or request.endpoint in UNPROFILED_ENDPOINTS:
+        return False  # Unrouted requests and the profile pages themselves
+    return valid_token(request_token()) or random.random() < current_app.config['PROFILE_SAMPLE_RATE']
+
+
+def start_profile():
+    g.profile = {
+        'started': time.perf_counter(),
+        'sampler': StackSampler(threading.get_ident(), current_app.config['PROFILE_INTERVAL']),
+        'queries': [],
+        'status': 500,
+    }
+    g.profile['sampler'].start()
+
+
+def stored_path():
+    # The profile token is a credential: keep it out of the saved path
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != PROFILE_ARG]
+    return f"{request.path}?{urlencode(args)}" if args else request.path
+
+
+def finish_profile():
+    profile = g.pop('profile')
+    profile['sampler'].stop()
+    duration = time.perf_counter() - profile['started']
+
+    name = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:6]}"
+    folder = profiles_folder()
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f"{name}.folded"), 'w') as f:
+        f.write(profile['sampler'].folded())
+    with open(os.path.join(folder, f"{name}.json"), 'w') as f:
+        json.dump({
+            'name': name,
+            'captured_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': stored_path(),
+            'endpoint': request.endpoint,
+            'user_id': current_user.get_id(),
+            'status': profile['status'],
+            'duration_ms': round(duration * 1000, 1),
+            'samples': sum(profile['sampler'].stacks.values()),
+            'sql_ms': round(sum(query['ms'] for query in profile['queries']), 1),
+            'queries': profile['queries'],
+        }, f, indent=1)
+    prune_profiles(folder, current_app.config['PROFILE_KEEP'])
+    return name
+
+
+def prune_profiles(folder, keep):
+    # Names start with the capture time, so the oldest sort first
+    names = sorted(entry[:-len('.json')] for entry in os.listdir(folder) if entry.endswith('.json'))
+    for name in names[:max(0, len(names) - keep)]:
+        for extension in ('.json', '.folded'):
+            path = os.path.join(folder, name + extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def list_profiles():
+    """Metadata of the captured profiles, newest first, without their SQL statements."""
+    folder = profiles_folder()
+    if not os.path.isdir(folder):
+        return []
+    profiles = []
+    for entry in sorted(os.listdir(folder), reverse=True):
+        if entry.endswith('.json'):
+            with open(os.path.join(folder, entry)) as f:
+                profile = json.load(f)
+            profile['query_count'] = len(profile.pop('queries'))
+            profiles.append(profile)
+    return profiles
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'profile' in g:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'profile' in g and conn.info.get('profile_started'):
+        elapsed = time.perf_counter() - conn.info['profile_started'].pop()
+        query = {'sql': statement, 'ms': round(elapsed * 1000, 2)}
+        if current_app.config['PROFILE_SQL_PARAMETERS']:
+            # Off by default: bound values include usernames, email addresses and password hashes
+            query['parameters'] = repr(parameters)[:200]
+        g.profile['queries'].append(query)
+
+
+def init_profiler(app):
+    """Profile requests carrying a valid profile token, and PROFILE_SAMPLE_RATE of the rest."""
+    @app.before_request
+    def start_request_profile():
+        if should_profile():
+            start_profile()
+
+    @app.after_request
+    def record_response_status(response):
+        if 'profile' in g:
+            g.profile['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_profile(exc):
+        if 'profile' in g:
+            try:
+                name = finish_profile()
+                app.logger.info("Profiled %s %s as %s", request.method, request.path, name)
+            except OSError:
+                app.logger.exception("Could not save the request profile")
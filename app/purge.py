@@ -0,0 +1,60 @@
+from sqlalchemy import text
+from . import db
+from .models import Exam
+from .archive import delete_archived_rows
+from .catalog import invalidate_catalog
+from .papers import forget_exam
+
+
+def referencing_columns(table_name):
+    """(table, column) pairs whose foreign key points at `table_name`."""
+    return [(table.name, foreign_key.parent.name)
+            for table in db.metadata.sorted_tables
+            for foreign_key in table.foreign_keys
+            if foreign_key.column.table.name == table_name]
+
+
+def delete_in_batches(table, where, params, batch_size):
+    # Each batch is its own short transaction so students are never blocked for long
+    deleted = 0
+    while True:
+        result = db.session.execute(text(
+            f'DELETE FROM "{table}" WHERE rowid IN (SELECT rowid FROM "{table}" WHERE {where} LIMIT :batch_size)'
+        ), dict(params, batch_size=batch_size))
+        db.session.commit()
+        if not result.rowcount:
+            return deleted
+        deleted += result.rowcount
+
+
+def _purge_children(parent, where, params, batch_size, counts):
+    for table, column in referencing_columns(parent):
+        counts[table] = counts.get(table, 0) + delete_in_batches(
+            table, f'"{column}" IN (SELECT id FROM "{parent}" WHERE {where})', params, batch_size)
+
+
+def purge_exam(exam_id, batch_size):
+    """Delete an exam and everything that belongs to it. Returns rows deleted per table."""
+    counts = {'archive': delete_archived_rows(exam_id)}
+    # Children go first, in batches, so the final delete has nothing left to cascade
+    _purge_children('exam', 'id = :exam_id', {'exam_id': exam_id}, batch_size, counts)
+    counts['exam'] = delete_in_batches('exam', 'id = :exam_id', {'exam_id': exam_id}, batch_size)
+    forget_exam(exam_id)
+    invalidate_catalog()
+    return counts
+
+
+def purge_course(course_id, batch_size):
+    """Delete a course with its exams, question bank and registrations. Returns rows deleted per table."""
+    counts = {}
+    for (exam_id,) in db.session.query(Exam.id).filter(Exam.course_id == course_id).all():
+        for table, deleted in purge_exam(exam_id, batch_size).items():
+            counts[table] = counts.get(table, 0) + deleted
+
+    params = {'course_id': course_id}
+    _purge_children('question', 'course_id = :course_id', params, batch_size, counts)
+    counts['question'] = delete_in_batches('question', 'course_id = :course_id', params, batch_size)
+    _purge_children('course', 'id = :course_id', params, batch_size, counts)
+    counts['course'] = delete_in_batches('course', 'id = :course_id', params, batch_size)
+    invalidate_catalog()
+    return counts
@@ -0,0 +1,162 @@
+import struct
+from flask import current_app
+from . import db
+from .models import ExamQuestion, Question, Answer, Response, PackedResponse
+
+
+# Statements shared with the async review endpoint (async_api.py), which runs them on its own session
+
+def exam_question_ids_query(exam_id):
+    # Question ids of an exam in the order packed answers are stored
+    return db.select(ExamQuestion.question_id).where(ExamQuestion.exam_id == exam_id).order_by(ExamQuestion.id)
+
+
+def user_responses_query(exam_id, user_id):
+    return db.select(Response.question_id, Response.response) \
+        .where(Response.exam_id == exam_id, Response.user_id == user_id)
+
+
+def review_questions_query(question_ids):
+    return db.select(Question.id, Question.question_text).where(Question.id.in_(question_ids))
+
+
+def review_answers_query(question_ids):
+    return db.select(Answer).where(Answer.question_id.in_(question_ids)).order_by(Answer.id)
+
+
+def exam_question_ids(exam_id):
+    return db.session.scalars(exam_question_ids_query(exam_id)).all()
+
+
+def pack_answers(answer_ids):
+    # Little-endian unsigned 32-bit ids so the blob reads the same on every platform
+    return struct.pack(f'<{len(answer_ids)}I', *answer_ids)
+
+
+def unpack_answers(data):
+    return list(struct.unpack(f'<{len(data) // 4}I', data))
+
+
+def save_responses(exam_id, user_id, question_ids, answers):
+    """Store a submission; `answers` maps question id to the selected answer id."""
+    if current_app.config.get('PACKED_RESPONSES'):
+        packed = pack_answers([answers.get(question_id, 0) for question_id in question_ids])
+        db.session.merge(PackedResponse(exam_id=exam_id, user_id=user_id, answers=packed))
+    else:
+        for question_id in question_ids:
+            if question_id in answers:
+                db.session.add(Response(
+                    exam_id=exam_id,
+                    user_id=user_id,
+                    question_id=question_id,
+                    response=answers[question_id]
+                ))
+
+
+def merge_packed(responses, question_ids, packed_answers):
+    """Add the answers of a packed submission to {question_id: answer_id}; 0 marks an unanswered question."""
+    for question_id, answer_id in zip(question_ids, unpack_answers(packed_answers)):
+        if answer_id:
+            responses[question_id] = answer_id
+    return responses
+
+
+def get_user_responses(exam_id, user_id, question_ids=None):
+    """Return {question_id: answer_id} for one submission, whichever representation holds it."""
+    responses = dict(db.session.execute(user_responses_query(exam_id, user_id)).all())
+
+    packed = db.session.get(PackedResponse, (exam_id, user_id))
+    if packed:
+        if question_ids is None:
+            question_ids = exam_question_ids(exam_id)
+        merge_packed(responses, question_ids, packed.answers)
+
+    return responses
+
+
+def iter_exam_responses(exam_id):
+    """Yield (user_id, question_id, answer_id) for every stored answer of an exam."""
+    for row in db.session.query(Response.user_id, Response.question_id, Response.response) \
+            .filter(Response.exam_id == exam_id):
+        yield row.user_id, row.question_id, row.response
+
+    question_ids = exam_question_ids(exam_id)
+    for packed in PackedResponse.query.filter_by(exam_id=exam_id):
+        for question_id, answer_id in zip(question_ids, unpack_answers(packed.answers)):
+            if answer_id:
+                yield packed.user_id, question_id, answer_id
+
+
+def pack_exam_responses(exam_id):
+    """Convert the Response rows of an exam into PackedResponse rows.
+
+    Rows for questions that are no longer part of the exam are left in place so
+    nothing is lost. Returns the number of submissions converted.
+    """
+    question_ids = exam_question_ids(exam_id)
+    positions = {question_id: i for i, question_id in enumerate(question_ids)}
+
+    submissions = {}
+    for row in Response.query.filter_by(exam_id=exam_id):
+        if row.question_id in positions:
+            submissions.setdefault(row.user_id, {})[row.question_id] = row.response
+
+    for user_id, answers in submissions.items():
+        existing = db.session.get(PackedResponse, (exam_id, user_id))
+        if existing:
+            for question_id, answer_id in zip(question_ids, unpack_answers(existing.answers)):
+                if answer_id:
+                    answers.setdefault(question_id, answer_id)
+        packed = pack_answers([answers.get(question_id, 0) for question_id in question_ids])
+        db.session.merge(PackedResponse(exam_id=exam_id, user_id=user_id, answers=packed))
+
+        Response.query.filter(
+            Response.exam_id == exam_id,
+            Response.user_id == user_id,
+            Response.question_id.in_(list(answers))
+        ).delete(synchronize_session=False)
+
+    db.session.commit()
+    return len(submissions)
+
+
+def build_review(question_ids, user_responses, questions, answers):
+    """Review JSON from {question_id: question_text} and {question_id: [Answer]}; deleted questions are skipped."""
+    questions_data = []
+    for question_id in question_ids:
+        if question_id not in questions:
+            continue
+        user_response = user_responses.get(question_id)
+
+        questions_data.append({
+            'question_text': questions[question_id],
+            'id': question_id,  # Store question id to use in the front-end
+            'answers': [{'answer_text': answer.answer_text,
+                         'is_correct': answer.is_correct,
+                         'is_selected': user_response == answer.id,
+                         'answer_id': answer.id}  # Store the answer ID for comparison
+                        for answer in answers.get(question_id, [])],
+            'selected_answer_id': user_response  # Store the selected answer ID
+        })
+    return {'questions': questions_data}
+
+
+def group_answers(answers):
+    grouped = {}
+    for answer in answers:
+        grouped.setdefault(answer.question_id, []).append(answer)
+    return grouped
+
+
+def submission_review(exam_id, user_id):
+    """The exam's questions with every answer marked correct/selected, for the results page."""
+    question_ids = exam_question_ids(exam_id)
+    user_responses = get_user_responses(exam_id, user_id, question_ids)
+    if not question_ids:
+        # Archived exams keep their questions and responses in the term archive
+        from .archive import archived_submission
+        question_ids, user_responses = archived_submission(exam_id, user_id) or ([], {})
+
+    questions = dict(db.session.execute(review_questions_query(question_ids)).all())
+    answers = group_answers(db.session.scalars(review_answers_query(question_ids)))
+    return build_review(question_ids, user_responses, questions, answers)
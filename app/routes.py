@@ -3,14 +3,28 @@ from flask import current_app as app, jsonify
 from . import db, bcrypt
 from datetime import datetime, date
 import random
-from .models import User, Course, UserCourse, Exam, Question, Answer, ExamQuestion, ExamBooking, Response, Evaluation
-from flask import flash, redirect, url_for, render_template, request
+from .models import User, Course, UserCourse, Exam, Question, Answer, ExamQuestion, ExamBooking, Evaluation, ExamStatistics
+from .responses import save_responses, exam_question_ids, submission_review
+from .archive import archived_exam_results, archived_user_evaluations, archived_evaluation, question_in_archives, delete_archived_rows
+from .search import search_questions
+from .dedupe import find_duplicates, index_question
+from .catalog import upcoming_catalog, invalidate_catalog
+from .admission import admit_student, queue_status, exam_deadline, queued_seconds, concurrency_limited
+from .papers import exam_paper, answer_key, forget_exam, invalidate_papers
+from .statistics import score_distribution, record_grade, discard_exam_statistics
+from .profiler import valid_token, request_token, list_profiles, profiles_folder
+from flask import flash, redirect, url_for, render_template, request, abort, send_from_directory
 
 
 # Ensure imports are not duplicated
 from werkzeug.security import check_password_hash
 
 
+@app.context_processor
+def inject_json_prefix():
+    # Under asgi.py the JSON fetches go to the async endpoints instead of these views
+    return {'json_prefix': app.config['ASYNC_JSON_PREFIX'] if app.config['ASYNC_JSON'] else ''}
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     print("Login route accessed")  # Debug statement
@@ -97,6 +111,13 @@ def forgot_password():
 
     return render_template('forgot_password.html')  # Create this template
 
+def flash_duplicates(duplicates):
+    # Warn the teacher about near-identical questions without blocking the save
+    if duplicates:
+        similar = '; '.join(f'"{question.question_text}" ({score:.0%})' for question, score in duplicates[:3])
+        flash(f"This question looks like a near-duplicate of: {similar}", 'warning')
+
+
 @app.route('/add_question/<int:course_id>', methods=['GET', 'POST'])
 @login_required
 def add_question(course_id):
@@ -106,6 +127,9 @@ def add_question(course_id):
             question_text = request.form['question_text']
             difficulty = request.form['difficulty']
 
+            # Look for near-duplicates already in the course bank
+            duplicates = find_duplicates(question_text, course_id=course_id)
+
             # Create a new Question
             new_question = Question(
                 question_text=question_text,
@@ -131,9 +155,11 @@ def add_question(course_id):
                 Answer(answer_text=answer4, question_id=new_question.id, is_correct=(correct_answer == 4))
             ]
             db.session.add_all(answers)
+            index_question(new_question)
             db.session.commit()
 
             flash('Question and answers added successfully!')
+            flash_duplicates(duplicates)
             return redirect(url_for('manage_questions', course_id=course_id))
 
         except KeyError as e:
@@ -164,11 +190,41 @@ def manage_questions(course_id):
         flash('You do not have permission to manage questions.')
         return redirect(url_for('index'))
 
-    # Fetch all questions for the given course, along with their answers
-    questions = Question.query.filter_by(course_id=course_id).all()
+    search_terms = request.args.get('q', '').strip()
+    difficulty = request.args.get('difficulty') or None
+
+    if search_terms:
+        # Ranked full-text search over the course bank
+        questions = search_questions(search_terms, course_id=course_id, difficulty=difficulty, limit=200)
+    else:
+        # Fetch all questions for the given course, along with their answers
+        query = Question.query.filter_by(course_id=course_id)
+        if difficulty:
+            query = query.filter_by(difficulty=difficulty)
+        questions = query.all()
 
     # Pass course_id to the template
-    return render_template('manage_questions.html', questions=questions, course_id=course_id)
+    return render_template('manage_questions.html', questions=questions, course_id=course_id,
+                           search_terms=search_terms, difficulty=difficulty)
+
+
+@app.route('/search_questions', methods=['GET'])
+@login_required
+def search_questions_api():
+    if current_user.role != 'Teacher':
+        return jsonify({'error': 'Access Denied'}), 403
+
+    course_id = request.args.get('course_id', type=int)
+    difficulty = request.args.get('difficulty') or None
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    questions = search_questions(request.args.get('q', ''), course_id=course_id, difficulty=difficulty, limit=limit)
+
+    return jsonify({'questions': [{
+        'id': question.id,
+        'question_text': question.question_text,
+        'difficulty': question.difficulty,
+        'course_id': question.course_id
+    } for question in questions]})
 
 
 
@@ -200,8 +256,12 @@ def edit_question(question_id):
             for i, answer in enumerate(question.answers):
                 answer.is_correct = (i + 1 == correct_answer)
 
+            duplicates = find_duplicates(question.question_text, course_id=question.course_id, exclude_id=question.id)
+            index_question(question)
             db.session.commit()
+            invalidate_papers(question.id)
             flash('Question updated successfully!')
+            flash_duplicates(duplicates)
             return redirect(url_for('manage_questions', course_id=question.course_id))
 
         except KeyError as e:
@@ -220,13 +280,19 @@ def delete_question(question_id):
 
     # Find the question by ID
     question = Question.query.get_or_404(question_id)
+    course_id = question.course_id
 
-    # Delete the question and all its associated answers
-    db.session.delete(question)
+    # Exams keep their questions: responses are stored by the question's position in the exam
+    if ExamQuestion.query.filter_by(question_id=question_id).first() or question_in_archives(question_id):
+        flash('This question is used by an exam and cannot be deleted.', 'danger')
+        return redirect(url_for('manage_questions', course_id=course_id))
+
+    # Delete the question; the database cascades to its answers and duplicate-detection index
+    Question.query.filter_by(id=question_id).delete(synchronize_session=False)
     db.session.commit()
 
     flash('Question and its answers have been deleted successfully.')
-    return redirect(url_for('manage_questions', course_id=question.course_id))
+    return redirect(url_for('manage_questions', course_id=course_id))
 
 
 
@@ -277,6 +343,7 @@ def add_course():
 
         db.session.add(new_course)
         db.session.commit()
+        invalidate_catalog()
         flash("Course added successfully!")
         return redirect(url_for('teacher_panel'))
 
@@ -298,12 +365,21 @@ def teacher_panel():
     exams = Exam.query.filter_by(created_by=current_user.id).all()
     results = Evaluation.query.filter_by(course_id=current_user.id).all()  # Student evaluations
 
+    # Finished exams have statistics computed by the scheduler; later bookings and submissions discard them
+    finalized = {statistics.exam_id: statistics for statistics in
+                 ExamStatistics.query.filter(ExamStatistics.exam_id.in_([exam.id for exam in exams]))}
+
     # Collect statistics for each exam, including course name
     exam_stats = []
     for exam in exams:
-        registered_students_count = ExamBooking.query.filter_by(exam_id=exam.id).count()
-        students_taken_exam = Evaluation.query.filter_by(exam_id=exam.id).count()
-        students_passed_exam = Evaluation.query.filter_by(exam_id=exam.id, pass_or_fail=True).count()
+        if exam.id in finalized:
+            registered_students_count = finalized[exam.id].registered_count
+            students_taken_exam = finalized[exam.id].taken_count
+            students_passed_exam = finalized[exam.id].passed_count
+        else:
+            registered_students_count = ExamBooking.query.filter_by(exam_id=exam.id).count()
+            students_taken_exam = Evaluation.query.filter_by(exam_id=exam.id).count()
+            students_passed_exam = Evaluation.query.filter_by(exam_id=exam.id, pass_or_fail=True).count()
 
         # Fetch the course associated with the exam
         course = Course.query.get(exam.course_id)
@@ -363,8 +439,13 @@ def delete_exam(exam_id):
     # Logic to delete the exam
     exam = Exam.query.get(exam_id)
     if exam:
+        # Archived rows live outside the database; clear them while the archive marker still says where
+        delete_archived_rows(exam_id)
+        # The database cascades to its questions, bookings, responses and results
         db.session.delete(exam)
         db.session.commit()
+        invalidate_catalog()
+        forget_exam(exam_id)
         flash("Exam deleted successfully!", "success")
     else:
         flash("Exam not found.", "danger")
@@ -424,8 +505,10 @@ def view_results(exam_id):
         .add_columns(User.first_name, User.last_name, User.email_address, Evaluation.grade, Evaluation.pass_or_fail, Evaluation.submission_date)
         .all()
     )
+    # Results of archived exams live in a cold-storage file
+    results += archived_exam_results(exam_id)
 
-    return render_template('view_results.html', results=results, exam=exam)
+    return render_template('view_results.html', results=results, exam=exam, distribution=score_distribution(exam_id))
 # Route to create an exam
 @app.route('/teacher_panel/create_exam/<int:course_id>', methods=['GET', 'POST'])
 @login_required
@@ -480,6 +563,7 @@ def create_exam(course_id):
             db.session.add(exam_question)
 
         db.session.commit()
+        invalidate_catalog()
         flash("Exam created successfully!")
         return redirect(url_for('manage_exams', course_id=course.id))
 
@@ -500,14 +584,14 @@ def available_courses():
         flash('Access Denied', 'danger')
         return redirect(url_for('index'))
 
-    # Fetch courses with at least one upcoming exam
-    upcoming_exams = db.session.query(Course).join(Exam).filter(Exam.date_scheduled >= date.today()).all()
+    # Courses with at least one upcoming exam, shared by all students
+    courses = upcoming_catalog()
 
     # Fetch the student's registered courses
     registered_course_ids = db.session.query(UserCourse.course_id).filter(UserCourse.user_id == current_user.id).all()
-    registered_course_ids = [course_id for (course_id,) in registered_course_ids]  # Unpack the result into a list
+    registered_course_ids = {course_id for (course_id,) in registered_course_ids}  # Unpack the result into a set
 
-    return render_template('student_courses.html', courses=upcoming_exams, registered_course_ids=registered_course_ids)
+    return render_template('student_courses.html', courses=courses, registered_course_ids=registered_course_ids)
 
 @app.route('/student/register_course/<int:course_id>', methods=['POST'])
 @login_required
@@ -617,6 +701,7 @@ def book_exam(exam_id):
     # Create a new exam booking
     booking = ExamBooking(user_id=current_user.id, exam_id=exam_id)
     db.session.add(booking)
+    discard_exam_statistics(exam_id)
     db.session.commit()
 
     # Send email confirmation (optional)
@@ -632,8 +717,26 @@ def book_exam(exam_id):
 
 
 
+def exam_waiting_room(exam_id):
+    # Shown while the student is queued or every exam slot of this process is busy
+    exam = Exam.query.get_or_404(exam_id)
+    return render_template('waiting_room.html', exam=exam, status=queue_status(exam_id, current_user.id))
+
+
+def exam_server_busy(exam_id):
+    return render_template('exam_busy.html', exam_id=exam_id), 503, {'Retry-After': '5'}
+
+
+@app.route('/exam_status/<int:exam_id>', methods=['GET'])
+@login_required
+def exam_status(exam_id):
+    # Polled by the waiting room; kept to primary-key and indexed queue lookups
+    return jsonify(queue_status(exam_id, current_user.id))
+
+
 @app.route('/take_exam/<int:exam_id>', methods=['GET', 'POST'])
 @login_required
+@concurrency_limited(0, exam_waiting_room)
 def take_exam(exam_id):
     # Check if the user is registered for the course of this exam
     exam = Exam.query.get_or_404(exam_id)
@@ -645,53 +748,56 @@ def take_exam(exam_id):
         flash("You are not registered for any courses.")
         return redirect(url_for('student_dashboard'))
 
-    # Get the questions for the exam
-    exam_questions = ExamQuestion.query.filter_by(exam_id=exam_id).all()
+    # Admission control: students enter in queue order at the exam's admission rate
+    admission = admit_student(exam.id, current_user.id)
+    if not admission.admitted_at:
+        return exam_waiting_room(exam_id)
 
-    # Retrieve the question details for each exam question
-    questions = []
-    for exam_question in exam_questions:
-        question = Question.query.get(exam_question.question_id)
-        if question:
-            questions.append(question)
+    # Get the questions and answers of the exam (compiled once, pre-warmed by the scheduler)
+    questions = exam_paper(exam_id)
 
-    # Pass duration in seconds
-    duration_seconds = exam.duration * 60
+    # Pass the time left in seconds; it counts from admission, so time spent queued is added back
+    time_remaining = max(0, int((exam_deadline(admission, exam) - datetime.utcnow()).total_seconds()))
 
-    return render_template('take_exam.html', exam=exam, questions=questions, exam_duration=duration_seconds)
+    return render_template('take_exam.html', exam=exam, questions=questions, exam_duration=time_remaining,
+                           queued_seconds=queued_seconds(admission))
 
 
 
 @app.route('/submit_exam/<int:exam_id>', methods=['POST'])
 @login_required
+@concurrency_limited('ADMISSION_SUBMIT_TIMEOUT', exam_server_busy)
 def submit_exam(exam_id):
     exam = Exam.query.get_or_404(exam_id)
-    exam_questions = ExamQuestion.query.filter_by(exam_id=exam_id).all()
+
+    # The scheduler finalizes exams that were left open, so a late submission may find one already
+    if Evaluation.query.filter_by(user_id=current_user.id, exam_id=exam_id).first():
+        flash("This exam has already been submitted.", "danger")
+        return redirect(url_for('student_panel'))
+
+    question_ids = exam_question_ids(exam_id)
+    correct_answers = answer_key(exam_id)
+    # The answer ids each question offers, as form values; anything else is left unanswered
+    offered = {question.id: {str(answer.id): answer.id for answer in question.answers} for question in exam_paper(exam_id)}
 
     correct_count = 0
-    total_questions = len(exam_questions)
+    total_questions = len(question_ids)
+    user_answers = {}
 
     # Process each question and user's answer
-    for exam_question in exam_questions:
-        question_id = exam_question.question_id
+    for question_id in question_ids:
         user_answer = request.form.get(f'question_{question_id}')
 
         # Check if the answer is correct
-        if user_answer:
-            # Save the user's response
-            response = Response(
-                exam_id=exam.id,
-                user_id=current_user.id,
-                question_id=question_id,
-                response=user_answer
-            )
-            db.session.add(response)
+        if user_answer in offered.get(question_id, {}):
+            user_answers[question_id] = offered[question_id][user_answer]
 
             # Check if the user's answer is correct
-            correct_answer = Answer.query.filter_by(question_id=question_id, is_correct=True).first()
-            if correct_answer and user_answer == str(correct_answer.id):  # Compare the user's answer ID with the correct one
+            if correct_answers.get(question_id) == user_answers[question_id]:  # Compare the user's answer ID with the correct one
                 correct_count += 1
 
+    # Save the user's responses (packed or one row per question, see PACKED_RESPONSES)
+    save_responses(exam.id, current_user.id, question_ids, user_answers)
     db.session.commit()
 
     # Calculate the grade
@@ -710,6 +816,8 @@ def submit_exam(exam_id):
         submission_date=datetime.utcnow()  # Set the current date and time as submission_date
     )
     db.session.add(evaluation)
+    record_grade(exam.id, grade)
+    discard_exam_statistics(exam.id)
     db.session.commit()
 
     flash(f"Your exam has been submitted successfully. Grade: {grade:.2f}%.", "success")
@@ -728,36 +836,53 @@ def exam_results():
     ).join(Exam, Evaluation.exam_id == Exam.id) \
      .join(ExamBooking, (Evaluation.exam_id == ExamBooking.exam_id) & (Evaluation.user_id == ExamBooking.user_id)) \
      .filter(Evaluation.user_id == current_user.id).all()
+    evaluations += archived_user_evaluations(current_user.id)
 
-    return render_template('exam_results.html', evaluations=evaluations)
+    # Percentile rank of each grade within its exam, read from the exam's score distribution
+    percentiles = {evaluation.exam_id: score_distribution(evaluation.exam_id).percentile(evaluation.grade)
+                   for evaluation, _, _, _ in evaluations}
+
+    return render_template('exam_results.html', evaluations=evaluations, percentiles=percentiles)
+
+
+@app.route('/exam_distribution/<int:exam_id>', methods=['GET'])
+@login_required
+def exam_distribution(exam_id):
+    evaluation = Evaluation.query.filter_by(user_id=current_user.id, exam_id=exam_id).first() \
+        or archived_evaluation(exam_id, current_user.id)
+    if current_user.role != 'Teacher' and not evaluation:
+        return jsonify({'error': 'Access Denied'}), 403
+
+    distribution = score_distribution(exam_id)
+    data = {
+        'exam_id': exam_id,
+        'total': distribution.total,
+        'counts': distribution.counts,  # Evaluations per whole grade, index 0-100
+        'histogram': distribution.histogram()
+    }
+    if evaluation:
+        data['grade'] = evaluation.grade
+        data['percentile'] = distribution.percentile(evaluation.grade)
+    return jsonify(data)
 
 
 @app.route('/exam_questions_answers/<int:exam_id>', methods=['GET'])
 @login_required
 def exam_questions_answers(exam_id):
-    exam_questions = ExamQuestion.query.filter_by(exam_id=exam_id).all()
-    questions_data = []
-
-    for exam_question in exam_questions:
-        question = Question.query.get(exam_question.question_id)
-        user_response = Response.query.filter_by(
-            exam_id=exam_id,
-            user_id=current_user.id,
-            question_id=question.id
-        ).first()
-
-        # Gather all answers for this question
-        answers = [{'answer_text': answer.answer_text,
-                    'is_correct': answer.is_correct,
-                    'is_selected': user_response.response == answer.id if user_response else False,
-                    'answer_id': answer.id}  # Store the answer ID for comparison
-                   for answer in question.answers]
-
-        questions_data.append({
-            'question_text': question.question_text,
-            'id': question.id,  # Store question id to use in the front-end
-            'answers': answers,
-            'selected_answer_id': user_response.response if user_response else None  # Store the selected answer ID
-        })
+    return jsonify(submission_review(exam_id, current_user.id))
+
+
+@app.route('/profiles', methods=['GET'])
+def profiles():
+    # There is no admin role: the profile token issued by flask profile-token is the credential
+    if not valid_token(request_token()):
+        abort(403)
+    return render_template('profiles.html', profiles=list_profiles(), token=request_token())
+
 
-    return jsonify({'questions': questions_data})
\ No newline at end of file
+@app.route('/profiles/<name>.<any(folded, json):kind>', methods=['GET'])
+def profile_file(name, kind):
+    if not valid_token(request_token()):
+        abort(403)
+    return send_from_directory(profiles_folder(), f"{name}.{kind}",
+                               mimetype='text/plain' if kind == 'folded' else 'application/json')
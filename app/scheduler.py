@@ -0,0 +1,192 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import Exam, Evaluation, ExamAdmission, ScheduledJob
+from .papers import warm_exam, answer_key, forget_exam
+from .admission import exam_deadline
+from .responses import exam_question_ids, get_user_responses
+from .statistics import compute_exam_statistics, record_grade
+
+# Jobs live in the scheduled_job table, so pending work survives restarts and
+# several processes can run the loop: a job only runs in the process that claims it.
+# Exam dates are entered in local time, so job times are local too.
+PREWARM = 'prewarm'
+FINALIZE = 'finalize'
+
+_thread = {}
+
+
+def exam_end(exam):
+    return exam.date_scheduled + timedelta(minutes=exam.duration or 0)
+
+
+def schedule_jobs(app):
+    """Create the prewarm and finalize jobs of exams that do not have them yet."""
+    now = datetime.now()
+    prewarm_before = timedelta(minutes=app.config['PREWARM_MINUTES'])
+    grace = timedelta(minutes=app.config['FINALIZE_GRACE_MINUTES'])
+
+    for kind in (PREWARM, FINALIZE):
+        exams = Exam.query.outerjoin(
+            ScheduledJob, db.and_(ScheduledJob.exam_id == Exam.id, ScheduledJob.kind == kind)
+        ).filter(ScheduledJob.id == None, Exam.date_scheduled != None).all()
+        for exam in exams:
+            status = 'pending'
+            if kind == PREWARM:
+                run_at = exam.date_scheduled - prewarm_before
+                if exam_end(exam) < now:
+                    # Nothing left to warm; recorded so the exam drops out of this query for good
+                    status = 'skipped'
+            else:
+                run_at = exam_end(exam) + grace
+            # Several processes may schedule the same exam at once; the unique (exam_id, kind) keeps one
+            db.session.execute(sqlite_insert(ScheduledJob).values(exam_id=exam.id, kind=kind, run_at=run_at, status=status)
+                               .on_conflict_do_nothing(index_elements=['exam_id', 'kind']))
+    db.session.commit()
+
+
+def recover_stale_jobs(app):
+    # Jobs left running by a process that died are handed out again
+    stale = datetime.now() - timedelta(minutes=app.config['SCHEDULER_STALE_MINUTES'])
+    ScheduledJob.query.filter(ScheduledJob.status == 'running', ScheduledJob.claimed_at < stale) \
+        .update({'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+
+
+def claim(job_id):
+    claimed = ScheduledJob.query.filter_by(id=job_id, status='pending') \
+        .update({'status': 'running', 'claimed_at': datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def finalize_exam(exam_id, batch_size, grace):
+    """Grade students whose time ran out without submitting, then compute the exam statistics.
+
+    A student's time runs from admission (see exam_deadline), so students admitted late
+    may still be writing. Returns how many were graded and, if some are still within
+    their time, when to run again (local time, like run_at).
+    """
+    question_ids = exam_question_ids(exam_id)
+    key = answer_key(exam_id)
+    exam = db.session.get(Exam, exam_id)
+
+    submitted = db.session.query(Evaluation.user_id).filter(Evaluation.exam_id == exam_id)
+    admissions = ExamAdmission.query.filter(
+        ExamAdmission.exam_id == exam_id,
+        ExamAdmission.admitted_at != None,
+        ExamAdmission.user_id.not_in(submitted)
+    ).all()
+    # Admission times are UTC
+    now = datetime.utcnow()
+    deadlines = {admission.user_id: exam_deadline(admission, exam) + grace for admission in admissions}
+    user_ids = [user_id for user_id, deadline in deadlines.items() if deadline <= now]
+    outstanding = [deadline for deadline in deadlines.values() if deadline > now]
+
+    for start in range(0, len(user_ids), batch_size):
+        for user_id in user_ids[start:start + batch_size]:
+            responses = get_user_responses(exam_id, user_id, question_ids)
+            correct_count = sum(1 for question_id, answer_id in responses.items() if key.get(question_id) == answer_id)
+            grade = (correct_count / len(question_ids)) * 100 if question_ids else 0
+            db.session.add(Evaluation(
+                user_id=user_id,
+                exam_id=exam_id,
+                course_id=exam.course_id,
+                answered_count=len(question_ids),
+                corrected_count=correct_count,
+                grade=grade,
+                pass_or_fail=grade >= exam.passing_grade,
+                submission_date=None  # Finalized by the scheduler, never submitted
+            ))
+            record_grade(exam_id, grade)
+        db.session.commit()
+
+    if outstanding:
+        # No snapshot while students are still writing; the teacher panel counts live meanwhile
+        return len(user_ids), datetime.now() + (max(outstanding) - now)
+    compute_exam_statistics(exam_id)
+    forget_exam(exam_id)
+    return len(user_ids), None
+
+
+def run_job(app, job):
+    """Run one job. Returns when to run it again, or None when it is done."""
+    if db.session.get(Exam, job.exam_id) is None:
+        return None  # The exam was deleted after the job was scheduled
+    if job.kind == PREWARM:
+        bookings = warm_exam(job.exam_id)
+        app.logger.info("Pre-warmed exam %s (%s bookings)", job.exam_id, bookings)
+    elif job.kind == FINALIZE:
+        grace = timedelta(minutes=app.config['FINALIZE_GRACE_MINUTES'])
+        finalized, run_again_at = finalize_exam(job.exam_id, app.config['FINALIZE_BATCH_SIZE'], grace)
+        app.logger.info("Finalized exam %s (%s outstanding submissions)", job.exam_id, finalized)
+        return run_again_at
+    return None
+
+
+def run_due_jobs(app, limit=20):
+    """Run jobs whose time has come. Returns how many ran."""
+    due = ScheduledJob.query.filter(ScheduledJob.status == 'pending', ScheduledJob.run_at <= datetime.now()) \
+        .order_by(ScheduledJob.run_at).limit(limit).all()
+    ran = 0
+    for job in due:
+        if not claim(job.id):
+            continue  # Another process got there first
+        try:
+            run_again_at = run_job(app, job)
+            if run_again_at:
+                # Students admitted late are still writing; finalize them when their time is up
+                job.status = 'pending'
+                job.run_at = run_again_at
+            else:
+                job.status = 'done'
+            job.error = None
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Scheduled %s of exam %s failed", job.kind, job.exam_id)
+            job.attempts += 1
+            job.error = str(e)[:500]
+            if job.attempts >= app.config['SCHEDULER_MAX_ATTEMPTS']:
+                job.status = 'failed'
+            else:
+                job.status = 'pending'
+                job.run_at = datetime.now() + timedelta(minutes=job.attempts)
+        job.finished_at = datetime.now()
+        db.session.commit()
+        ran += 1
+    return ran
+
+
+def run_scheduler_once(app):
+    with app.app_context():
+        schedule_jobs(app)
+        return run_due_jobs(app)
+
+
+def run_scheduler_forever(app):
+    with app.app_context():
+        recover_stale_jobs(app)
+    while True:
+        try:
+            run_scheduler_once(app)
+        except Exception:
+            app.logger.exception("Exam scheduler tick failed")
+        time.sleep(app.config['SCHEDULER_INTERVAL'])
+
+
+def start_scheduler(app):
+    """Run the scheduler in a daemon thread of this process, once."""
+    if not app.config['SCHEDULER_ENABLED'] or 'thread' in _thread:
+        return
+    _thread['thread'] = threading.Thread(target=run_scheduler_forever, args=(app,), name='exam-scheduler', daemon=True)
+    _thread['thread'].start()
+
+
+def init_scheduler(app):
+    # Started by the first request rather than create_app, so flask CLI commands never start it
+    @app.before_request
+    def start_scheduler_once():
+        if 'thread' not in _thread:
+            start_scheduler(app)
@@ -0,0 +1,102 @@
+import re
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+from . import db
+
+
+def _needs_rebuild(conn, table):
+    # Compare the ON DELETE action of each foreign key with the model's
+    existing = {
+        (row[3], row[2]): (row[6] or 'NO ACTION').upper()
+        for row in conn.exec_driver_sql(f'PRAGMA foreign_key_list("{table.name}")')
+    }
+    if not existing and not table.foreign_keys:
+        return False
+    for foreign_key in table.foreign_keys:
+        wanted = (foreign_key.ondelete or 'NO ACTION').upper()
+        if existing.get((foreign_key.parent.name, foreign_key.column.table.name)) != wanted:
+            return True
+    return False
+
+
+def _rebuild(conn, table):
+    # SQLite cannot change a foreign key in place: create the new table, copy, drop, rename
+    new_name = f"new_{table.name}"
+    ddl = str(CreateTable(table).compile(dialect=conn.dialect)).strip()
+    ddl = re.sub(r'^CREATE TABLE\s+("?)' + re.escape(table.name) + r'\1', f'CREATE TABLE "{new_name}"', ddl)
+    existing_columns = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+    columns = ', '.join(f'"{column.name}"' for column in table.columns if column.name in existing_columns)
+
+    conn.exec_driver_sql(ddl)
+    conn.exec_driver_sql(f'INSERT INTO "{new_name}" ({columns}) SELECT {columns} FROM "{table.name}"')
+    conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+    conn.exec_driver_sql(f'ALTER TABLE "{new_name}" RENAME TO "{table.name}"')
+    for index in table.indexes:
+        index.create(conn)
+
+
+def _cascading_orphans(conn):
+    # Rows whose parent is gone, limited to foreign keys that would have deleted them
+    cascading = {
+        (table.name, foreign_key.column.table.name)
+        for table in db.metadata.sorted_tables
+        for foreign_key in table.foreign_keys if (foreign_key.ondelete or '').upper() == 'CASCADE'
+    }
+    return [(table_name, rowid)
+            for table_name, rowid, parent, _ in conn.exec_driver_sql('PRAGMA foreign_key_check').all()
+            if (table_name, parent) in cascading]
+
+
+def ensure_cascading_foreign_keys():
+    """Rebuild tables whose foreign keys' ON DELETE action differs from the model's.
+
+    Rows left orphaned by earlier deletes are removed on the way, since they would
+    fail the foreign key check once enforcement is on. Triggers on rebuilt tables are
+    dropped with them; ensure_search_index() recreates its own afterwards.
+    Returns the names of the rebuilt tables.
+    """
+    with db.engine.connect() as conn:
+        tables = [table for table in db.metadata.sorted_tables if _needs_rebuild(conn, table)]
+        if not tables:
+            return []
+
+        # Foreign keys can only be switched off outside a transaction
+        conn.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        conn.commit()
+        try:
+            conn.exec_driver_sql('BEGIN')
+            for table in tables:
+                _rebuild(conn, table)
+            # Removing an orphan can orphan its own children, so repeat until none are left
+            orphans = _cascading_orphans(conn)
+            while orphans:
+                for table_name, rowid in orphans:
+                    conn.execute(text(f'DELETE FROM "{table_name}" WHERE rowid = :rowid'), {'rowid': rowid})
+                orphans = _cascading_orphans(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql('PRAGMA foreign_keys=ON')
+            conn.commit()
+
+    return [table.name for table in tables]
+
+
+def ensure_foreign_key_indexes():
+    """Create the models' indexes missing from an older database.
+
+    create_all() only creates missing tables, so the indexes on foreign key columns,
+    which let deletes and the batched purge find child rows without scanning, are
+    added here. Returns the names of the created indexes.
+    """
+    created = []
+    with db.engine.begin() as conn:
+        existing = {name for (name,) in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    created.append(index.name)
+    return created
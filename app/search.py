@@ -0,0 +1,101 @@
+import re
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from . import db
+from .models import Question
+
+# question_fts mirrors Question (rowid = question.id) plus the text of its answers.
+# course_id and difficulty are stored unindexed so results can be filtered without a join.
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS question_fts USING fts5("
+    "question_text, answers_text, course_id UNINDEXED, difficulty UNINDEXED, prefix='2 3')",
+    "CREATE INDEX IF NOT EXISTS ix_answer_question_id ON answer (question_id)",
+    "CREATE TRIGGER IF NOT EXISTS question_fts_insert AFTER INSERT ON question BEGIN "
+    "INSERT INTO question_fts (rowid, question_text, answers_text, course_id, difficulty) "
+    "VALUES (new.id, new.question_text, '', new.course_id, new.difficulty); END",
+    "CREATE TRIGGER IF NOT EXISTS question_fts_update AFTER UPDATE ON question BEGIN "
+    "UPDATE question_fts SET question_text = new.question_text, course_id = new.course_id, "
+    "difficulty = new.difficulty WHERE rowid = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS question_fts_delete AFTER DELETE ON question BEGIN "
+    "DELETE FROM question_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS answer_fts_insert AFTER INSERT ON answer BEGIN "
+    "UPDATE question_fts SET answers_text = (SELECT group_concat(answer_text, ' ') FROM answer "
+    "WHERE question_id = new.question_id) WHERE rowid = new.question_id; END",
+    "CREATE TRIGGER IF NOT EXISTS answer_fts_update AFTER UPDATE ON answer BEGIN "
+    "UPDATE question_fts SET answers_text = (SELECT group_concat(answer_text, ' ') FROM answer "
+    "WHERE question_id = question_fts.rowid) WHERE rowid IN (old.question_id, new.question_id); END",
+    "CREATE TRIGGER IF NOT EXISTS answer_fts_delete AFTER DELETE ON answer BEGIN "
+    "UPDATE question_fts SET answers_text = (SELECT group_concat(answer_text, ' ') FROM answer "
+    "WHERE question_id = old.question_id) WHERE rowid = old.question_id; END",
+]
+
+
+def search_available():
+    return db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'question_fts'"
+    )).first() is not None
+
+
+def ensure_search_index():
+    """Create the FTS5 table and its triggers, filling the index the first time."""
+    created = not search_available()
+    try:
+        for statement in SEARCH_SCHEMA:
+            db.session.execute(text(statement))
+        db.session.commit()
+    except OperationalError:
+        # SQLite was built without FTS5; search_questions falls back to LIKE
+        db.session.rollback()
+        return False
+    if created:
+        rebuild_search_index()
+    return True
+
+
+def rebuild_search_index():
+    """Repopulate question_fts from Question and Answer. Returns the number of questions indexed."""
+    db.session.execute(text("DELETE FROM question_fts"))
+    db.session.execute(text(
+        "INSERT INTO question_fts (rowid, question_text, answers_text, course_id, difficulty) "
+        "SELECT q.id, q.question_text, COALESCE(group_concat(a.answer_text, ' '), ''), q.course_id, q.difficulty "
+        "FROM question q LEFT JOIN answer a ON a.question_id = q.id GROUP BY q.id"
+    ))
+    db.session.execute(text("INSERT INTO question_fts (question_fts) VALUES ('optimize')"))
+    db.session.commit()
+    return db.session.execute(text("SELECT COUNT(*) FROM question_fts")).scalar()
+
+
+def match_expression(terms):
+    # Every word must match as a prefix; quoting keeps FTS5 operators in user input literal
+    words = re.findall(r'\w+', terms)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_questions(terms, course_id=None, difficulty=None, limit=50):
+    """Questions matching `terms` in their text or answers, best match first."""
+    expression = match_expression(terms)
+    if not expression:
+        return []
+
+    if not search_available():
+        query = Question.query.filter(Question.question_text.like(f"%{terms}%"))
+        if course_id is not None:
+            query = query.filter(Question.course_id == course_id)
+        if difficulty:
+            query = query.filter(Question.difficulty == difficulty)
+        return query.limit(limit).all()
+
+    sql = "SELECT rowid FROM question_fts WHERE question_fts MATCH :expression"
+    params = {'expression': expression, 'limit': limit}
+    if course_id is not None:
+        sql += " AND course_id = :course_id"
+        params['course_id'] = course_id
+    if difficulty:
+        sql += " AND difficulty = :difficulty"
+        params['difficulty'] = difficulty
+    # Matches in the question text weigh twice as much as matches in its answers
+    sql += " ORDER BY bm25(question_fts, 2.0, 1.0) LIMIT :limit"
+
+    question_ids = [question_id for (question_id,) in db.session.execute(text(sql), params)]
+    questions = {question.id: question for question in Question.query.filter(Question.id.in_(question_ids))}
+    return [questions[question_id] for question_id in question_ids if question_id in questions]
@@ -0,0 +1,95 @@
+from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db
+from .models import Evaluation, ExamBooking, ExamStatistics, ScoreBucket, ArchivedExam
+
+
+def compute_exam_statistics(exam_id):
+    """Store booking, submission and pass counts and the average grade of an exam."""
+    taken, passed, average = db.session.query(
+        db.func.count(Evaluation.user_id),
+        db.func.sum(db.case((Evaluation.pass_or_fail == True, 1), else_=0)),
+        db.func.avg(Evaluation.grade)
+    ).filter(Evaluation.exam_id == exam_id).one()
+
+    statistics = db.session.get(ExamStatistics, exam_id) or ExamStatistics(exam_id=exam_id)
+    statistics.registered_count = ExamBooking.query.filter_by(exam_id=exam_id).count()
+    statistics.taken_count = taken
+    statistics.passed_count = passed or 0
+    statistics.average_grade = average
+    statistics.computed_at = datetime.utcnow()
+    db.session.add(statistics)
+    db.session.commit()
+    return statistics
+
+
+def discard_exam_statistics(exam_id):
+    # A booking or submission after the snapshot makes it stale; the panel counts live until the next one
+    ExamStatistics.query.filter_by(exam_id=exam_id).delete(synchronize_session=False)
+
+
+def grade_bucket(grade):
+    return min(100, max(0, int(grade)))
+
+
+class ScoreDistribution:
+    """Counts of evaluations per whole grade 0-100 for one exam.
+
+    With a fixed 101 buckets, a percentile is a prefix sum over at most 101 counts,
+    so it costs the same for ten students as for ten thousand.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.total = sum(counts)
+
+    def percentile(self, grade):
+        # Share of students scoring below this grade, counting ties as half
+        if not self.total:
+            return None
+        bucket = grade_bucket(grade)
+        below = sum(self.counts[:bucket])
+        return (below + self.counts[bucket] / 2) / self.total * 100
+
+    def histogram(self, bin_size=10):
+        # Coarser bins for display; the last bin also holds grade 100
+        bins = [sum(self.counts[start:start + bin_size]) for start in range(0, 100, bin_size)]
+        bins[-1] += self.counts[100]
+        return [{'from': start, 'to': 100 if start + bin_size >= 100 else start + bin_size - 1, 'count': count}
+                for start, count in zip(range(0, 100, bin_size), bins)]
+
+
+def score_distribution(exam_id):
+    counts = [0] * 101
+    for grade, count in db.session.query(ScoreBucket.grade, ScoreBucket.count).filter(ScoreBucket.exam_id == exam_id):
+        counts[grade] = count
+    return ScoreDistribution(counts)
+
+
+def record_grade(exam_id, grade):
+    """Count one more evaluation in the exam's distribution, in the caller's transaction."""
+    # An atomic upsert, so concurrent submissions never lose a count
+    statement = sqlite_insert(ScoreBucket).values(exam_id=exam_id, grade=grade_bucket(grade), count=1)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['exam_id', 'grade'],
+        set_={'count': ScoreBucket.count + 1}
+    ))
+
+
+def rebuild_score_distributions():
+    """Recount every exam's distribution from the Evaluation table. Returns the number of exams."""
+    # Archived exams keep their buckets: their evaluations are no longer in the hot database
+    archived = db.session.query(ArchivedExam.exam_id)
+    ScoreBucket.query.filter(ScoreBucket.exam_id.not_in(archived)).delete(synchronize_session=False)
+    bucket = db.func.min(100, db.func.max(0, db.cast(Evaluation.grade, db.Integer)))
+    rows = db.session.query(Evaluation.exam_id, bucket, db.func.count()) \
+        .filter(Evaluation.exam_id.not_in(archived)).group_by(Evaluation.exam_id, bucket).all()
+    db.session.add_all(ScoreBucket(exam_id=exam_id, grade=grade, count=count) for exam_id, grade, count in rows)
+    db.session.commit()
+    return len({exam_id for exam_id, _, _ in rows})
+
+
+def ensure_score_distributions():
+    # Evaluations stored before distributions existed are counted once, on first start
+    if ScoreBucket.query.first() is None and Evaluation.query.first() is not None:
+        rebuild_score_distributions()
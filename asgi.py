@@ -0,0 +1,7 @@
+from app import create_app
+from app.async_api import AsyncJsonApp
+
+# Serve with: uvicorn asgi:application
+flask_app = create_app()
+flask_app.config['ASYNC_JSON'] = True
+application = AsyncJsonApp(flask_app)
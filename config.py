@@ -1,6 +1,32 @@
 import os
 
 class Config:
-    SECRET_KEY = os.urandom(24)
+    SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(24)  # Set SECRET_KEY so every worker accepts the same sessions
     SQLALCHEMY_DATABASE_URI = 'sqlite:///app.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    PACKED_RESPONSES = False  # Store each submission as one PackedResponse row instead of Response rows
+    ARCHIVE_AFTER_DAYS = 730  # Finished exams older than this are moved to instance/archive
+    ARCHIVE_BATCH_SIZE = 1000  # Rows moved per archive transaction
+    DUPLICATE_THRESHOLD = 0.8  # Estimated similarity above which a question is flagged as a near-duplicate
+    CATALOG_CACHE_SECONDS = 300  # Upper bound on how stale the shared course catalog can get
+    ADMISSION_RATE = 20.0  # Students admitted into an exam per second, unless set per exam
+    ADMISSION_BURST = 50  # Students admitted at once when the exam opens, unless set per exam
+    ADMISSION_MAX_CONCURRENT = 32  # take_exam/submit_exam requests handled at once per process
+    ADMISSION_SUBMIT_TIMEOUT = 10  # Seconds a submission waits for a free slot before asking to retry
+    PAPER_CACHE_SIZE = 256  # Compiled exam papers and answer keys kept per process
+    SCHEDULER_ENABLED = True  # Run the exam scheduler inside the web process; disable when using flask run-scheduler
+    SCHEDULER_INTERVAL = 30  # Seconds between scheduler runs
+    PREWARM_MINUTES = 10  # Compile papers and answer keys this long before an exam starts
+    FINALIZE_GRACE_MINUTES = 15  # Finalize outstanding submissions this long after an exam ends
+    FINALIZE_BATCH_SIZE = 500  # Evaluations written per transaction when finalizing
+    SCHEDULER_MAX_ATTEMPTS = 3  # A failing job is retried this many times
+    SCHEDULER_STALE_MINUTES = 30  # Running jobs older than this are retried after a restart
+    PURGE_BATCH_SIZE = 1000  # Rows deleted per transaction by flask purge-exam/purge-course
+    ASYNC_JSON = False  # Set by asgi.py: pages call the async JSON endpoints under ASYNC_JSON_PREFIX
+    ASYNC_JSON_PREFIX = '/async'
+    PROFILE_SECRET = os.environ.get('PROFILE_SECRET')  # Signs profile tokens (flask profile-token); unset disables them
+    PROFILE_TOKEN_MAX_AGE = 3600  # Seconds a profile token stays valid
+    PROFILE_SAMPLE_RATE = 0.0  # Fraction of all requests profiled without a token
+    PROFILE_INTERVAL = 0.001  # Seconds between stack samples of a profiled request
+    PROFILE_SQL_PARAMETERS = False  # Also store bound SQL parameters in profiles; they can hold personal data
+    PROFILE_KEEP = 200  # Profiles kept in instance/profiles; the oldest are deleted first